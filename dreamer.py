@@ -7,82 +7,747 @@ import time
 import os
 import errno
 import subprocess
+import resource
+import itertools
+import functools
+import sys
+import json
+import hashlib
+import multiprocessing
+import math
+import threading
+import collections
+import Queue
+import shutil
+from multiprocessing.pool import ThreadPool
 #import natsort
 
 from cStringIO import StringIO
 import numpy as np
 import scipy.ndimage as nd
 import PIL.Image
-from google.protobuf import text_format
-import caffe
+
+# Network backends
+# the dream code only needs the few operations of Backend, so the network behind it can be swapped.
+# images go in and out in Caffe's layout: (n, 3, h, w), BGR, 0-255 minus the mean.
+
+class Blob(object):
+    def __init__(self, data):
+        self.data = data
+        self.diff = np.zeros_like(data)
+
+
+class Backend(object):
+    '''Network interface of make_step, deepdream and the guide setup.'''
+
+    default_layer = None
+
+    @property
+    def mean(self):
+        '''Per channel mean of the input, shape (3, 1, 1), BGR.'''
+        raise NotImplementedError
+
+    @property
+    def input(self):
+        '''Input blob: data is the image batch, diff the gradient backward writes.'''
+        raise NotImplementedError
+
+    def reshape(self, n, h, w):
+        '''Resize the input to a batch of n h x w images.'''
+        raise NotImplementedError
+
+    def forward(self, end):
+        '''Run the input up to layer end and return its blob. Objectives set its diff.'''
+        raise NotImplementedError
+
+    def backward(self, end):
+        '''Propagate the diff of layer end back to the input diff.'''
+        raise NotImplementedError
+
+    def buffer(self, name, shape, lean=False):
+        '''Scratch array of the dream code, kept for the next frames of the same size.
+        With lean, the other sizes kept of that name are dropped.'''
+        buffers = self.__dict__.setdefault('buffers', {})
+        key = (name, tuple(shape))
+        if key not in buffers:
+            if lean:
+                for other in [other for other in buffers if other[0] == name]:
+                    del buffers[other]
+            buffers[key] = np.empty(shape, np.float32)
+        return buffers[key]
+
+
+class NumpyBackend(Backend):
+    '''Backend whose input is a Blob of numpy arrays, with Caffe's mean. Subclasses run forward and backward.'''
+
+    def __init__(self):
+        self._mean = np.float32([104.0, 116.0, 122.0])[:, np.newaxis, np.newaxis]
+        self.reshape(1, 224, 224)
+
+    @property
+    def mean(self):
+        return self._mean
+
+    @property
+    def input(self):
+        return self.src
+
+    def reshape(self, n, h, w):
+        if getattr(self, 'src', None) is None or self.src.data.shape != (n, 3, h, w):
+            self.src = Blob(np.zeros((n, 3, h, w), np.float32))
+
+
+def patchModel(modeldir):
+    from google.protobuf import text_format
+    import caffe
+
+    # Loading DNN model
+    model_name = 'bvlc_googlenet'
+    model_path = os.path.join(modeldir, model_name)
+    net_fn = os.path.join(model_path, 'deploy.prototxt')
+    param_fn = os.path.join(model_path, 'bvlc_googlenet.caffemodel')
+
+    # Patching model to be able to compute gradients.
+    # Note that you can also manually add "force_backward: true" line to "deploy.prototxt".
+    model = caffe.io.caffe_pb2.NetParameter()
+    text_format.Merge(open(net_fn).read(), model)
+    model.force_backward = True
+    # written through a rename, as worker processes patch the model at the same time
+    open('tmp.prototxt.%d' % os.getpid(), 'w').write(str(model))
+    os.rename('tmp.prototxt.%d' % os.getpid(), 'tmp.prototxt')
+    return 'tmp.prototxt', param_fn
+
+
+class CaffeBackend(Backend):
+    default_layer = 'inception_4c/output'
+
+    def __init__(self, modeldir, gpu):
+        import caffe
+        net_fn, param_fn = patchModel(modeldir)
+        self.net = caffe.Classifier(net_fn, param_fn,
+                                    mean=np.float32([104.0, 116.0, 122.0]),  # ImageNet mean, training set dependent
+                                    channel_swap=(2, 1, 0))  # the reference model has channels in BGR order instead of RGB
+
+        if gpu is 1:
+            caffe.set_mode_gpu()
+            caffe.set_device(0)
+
+    @property
+    def mean(self):
+        return self.net.transformer.mean['data']
+
+    @property
+    def input(self):
+        return self.net.blobs['data']  # input image is stored in Net's 'data' blob
+
+    def reshape(self, n, h, w):
+        self.net.blobs['data'].reshape(n, 3, h, w)
+
+    def forward(self, end):
+        self.net.forward(end=end)
+        return self.net.blobs[end]
+
+    def backward(self, end):
+        self.net.backward(start=end)
+
+
+class TorchBackend(NumpyBackend):
+    # torchvision's GoogLeNet, on as many CPU threads as asked for. Caffe layer names are translated,
+    # so the same --layers work: inception_4c/output is inception4c.
+    default_layer = 'inception_4c/output'
+    caffe_names = {'conv1/7x7_s2': 'conv1', 'pool1/3x3_s2': 'maxpool1', 'conv2/3x3_reduce': 'conv2',
+                   'conv2/3x3': 'conv3', 'pool2/3x3_s2': 'maxpool2', 'pool3/3x3_s2': 'maxpool3',
+                   'pool4/3x3_s2': 'maxpool4'}
+
+    def __init__(self, gpu, threads=None):
+        import torch
+        import torchvision
+        NumpyBackend.__init__(self)
+        if threads:
+            torch.set_num_threads(threads)
+        self.torch = torch
+        self.device = torch.device('cuda' if gpu is 1 and torch.cuda.is_available() else 'cpu')
+        self.model = torchvision.models.googlenet(pretrained=True).eval().to(self.device)
+        for parameter in self.model.parameters():
+            parameter.requires_grad_(False)
+        self.layers = [(name, module) for name, module in self.model.named_children()
+                       if name.startswith('conv') or name.startswith('maxpool') or name.startswith('inception')]
+        # from Caffe's BGR 0-255 input to torchvision's normalized RGB
+        self.shift = torch.tensor((self._mean[::-1] / 255.0 - [[[0.485]], [[0.456]], [[0.406]]]) /
+                                  [[[0.229]], [[0.224]], [[0.225]]], dtype=torch.float32, device=self.device)
+        self.scale = torch.tensor(1.0 / (255.0 * np.float32([0.229, 0.224, 0.225])[:, np.newaxis, np.newaxis]),
+                                  dtype=torch.float32, device=self.device)
+
+    def layer(self, end):
+        if end in self.caffe_names:
+            return self.caffe_names[end]
+        return end.replace('/output', '').replace('_', '')
+
+    def forward(self, end):
+        torch = self.torch
+        name = self.layer(end)
+        self.x = torch.from_numpy(self.src.data).to(self.device).requires_grad_()
+        y = self.x.flip(1) * self.scale + self.shift
+        if self.model.transform_input:
+            y = self.model._transform_input(y)
+        for layer, module in self.layers:
+            y = module(y)
+            if layer == name:
+                break
+        else:
+            raise KeyError('No layer ' + end + ' in GoogLeNet')
+        self.y = y
+        self.dst = Blob(y.detach().cpu().numpy())
+        return self.dst
+
+    def backward(self, end):
+        self.y.backward(self.torch.from_numpy(self.dst.diff).to(self.device))
+        self.src.diff[:] = self.x.grad.cpu().numpy()
+
+
+def conv3x3(x, weights):
+    # 3x3 convolution, stride 1, zero padded to keep the size
+    n, c, h, w = x.shape
+    padded = np.pad(x, ((0, 0), (0, 0), (1, 1), (1, 1)), 'constant')
+    out = np.zeros((n, weights.shape[0], h, w), np.float32)
+    for dy in xrange(3):
+        for dx in xrange(3):
+            patch = padded[:, :, dy:dy + h, dx:dx + w]
+            out += np.tensordot(weights[:, :, dy, dx], patch, axes=([1], [1])).transpose(1, 0, 2, 3)
+    return out
+
+
+def conv3x3_backward(diff, weights):
+    n, o, h, w = diff.shape
+    padded = np.zeros((n, weights.shape[1], h + 2, w + 2), np.float32)
+    for dy in xrange(3):
+        for dx in xrange(3):
+            padded[:, :, dy:dy + h, dx:dx + w] += np.tensordot(weights[:, :, dy, dx], diff,
+                                                               axes=([0], [1])).transpose(1, 0, 2, 3)
+    return padded[:, :, 1:-1, 1:-1]
+
+
+class SyntheticBackend(NumpyBackend):
+    # tiny conv net with fixed random weights, in numpy. Its dreams mean nothing,
+    # but it runs the whole pipeline with no model download, for tests and benchmarks.
+    default_layer = 'conv3'
+
+    def __init__(self, seed=0):
+        NumpyBackend.__init__(self)
+        rng = np.random.RandomState(seed)
+        self.weights = {}
+        for name, cin, cout in [('conv1', 3, 16), ('conv2', 16, 32), ('conv3', 32, 64)]:
+            self.weights[name] = np.float32(rng.randn(cout, cin, 3, 3) * np.sqrt(2.0 / (cin * 9)))
+        self.layers = ['conv1', 'pool1', 'conv2', 'pool2', 'conv3']
+
+    def forward(self, end):
+        if end not in self.layers:
+            raise KeyError('No layer ' + end + ' in the synthetic net, use one of ' + ', '.join(self.layers))
+        self.activations = []
+        x = self.src.data / 64.0
+        for layer in self.layers[:self.layers.index(end) + 1]:
+            self.activations.append(x)
+            if layer.startswith('conv'):
+                x = np.maximum(conv3x3(x, self.weights[layer]), 0)
+            else:
+                # 2x2 average pooling, odd edges dropped
+                h, w = x.shape[2] // 2 * 2, x.shape[3] // 2 * 2
+                x = x[:, :, :h, :w].reshape(x.shape[0], x.shape[1], h // 2, 2, w // 2, 2).mean(axis=(3, 5))
+        self.dst = Blob(x)
+        return self.dst
+
+    def backward(self, end):
+        layers = self.layers[:self.layers.index(end) + 1]
+        outputs = self.activations[1:] + [self.dst.data]
+        diff = self.dst.diff
+        for layer, x, y in reversed(zip(layers, self.activations, outputs)):
+            if layer.startswith('conv'):
+                diff = conv3x3_backward(diff * (y > 0), self.weights[layer])
+            else:
+                full = np.zeros_like(x)
+                h, w = diff.shape[2] * 2, diff.shape[3] * 2
+                full[:, :, :h, :w] = diff.repeat(2, axis=2).repeat(2, axis=3) / 4.0
+                diff = full
+        self.src.diff[:] = diff / 64.0
+
+
+class NullBackend(NumpyBackend):
+    # identity "network" without any cost, to time everything deepdream does around the net
+    default_layer = 'data'
+
+    def forward(self, end):
+        return self.src  # the objective writes the input diff directly
+
+    def backward(self, end):
+        pass
+
+
+BACKENDS = {'caffe': CaffeBackend, 'torch': TorchBackend, 'synthetic': SyntheticBackend}
+
+
+def loadNet(backend, modeldir, gpu, threads=None):
+    if backend == 'torch':
+        return TorchBackend(gpu, threads)
+    if backend == 'synthetic':
+        return SyntheticBackend()
+    return CaffeBackend(modeldir, gpu)
+
 
 # a couple of utility functions for converting to and from Caffe's input image layout
 def preprocess(net, img):
-    return np.float32(np.rollaxis(img, 2)[::-1]) - net.transformer.mean['data']
+    return np.float32(np.rollaxis(img, 2)[::-1]) - net.mean
 
 
 def deprocess(net, img):
-    return np.dstack((img + net.transformer.mean['data'])[::-1])
+    return np.dstack((img + net.mean)[::-1])
 
 
 def objective_L2(dst):
     dst.diff[:] = dst.data
 
 
+def roll(img, ox, oy, out):
+    # np.roll(np.roll(img, ox, -1), oy, -2) written into out, without temporary arrays
+    h, w = img.shape[-2:]
+    ox, oy = ox % w, oy % h
+    for ys, yd in ((slice(0, h - oy), slice(oy, h)), (slice(h - oy, h), slice(0, oy))):
+        for xs, xd in ((slice(0, w - ox), slice(ox, w)), (slice(w - ox, w), slice(0, ox))):
+            out[..., yd, xd] = img[..., ys, xs]
+    return out
+
+
+def resize(img, h, w, out):
+    # bilinear resize of the last two axes into out, with OpenCV when it is installed
+    try:
+        import cv2
+    except ImportError:
+        zoom = (1,) * (img.ndim - 2) + (1.0 * h / img.shape[-2], 1.0 * w / img.shape[-1])
+        return nd.zoom(img, zoom, output=out, order=1)
+    planes = img.reshape((-1,) + img.shape[-2:])
+    for plane, resized in zip(planes, out.reshape(-1, h, w)):
+        cv2.resize(plane, (w, h), dst=resized, interpolation=cv2.INTER_LINEAR)
+    return out
+
+
+def octaveShapes(h, w, octave_n, octave_scale):
+    # image size of every octave, largest first
+    shapes = [(h, w)]
+    for i in xrange(octave_n - 1):
+        h, w = shapes[-1]
+        shapes.append((int(round(h / octave_scale)), int(round(w / octave_scale))))
+    return shapes
+
+
 # First we implement a basic gradient ascent step function, applying the first two tricks // 32:
-def make_step(net, step_size=1.5, end='inception_4c/output', jitter=32, clip=True, objective=objective_L2):
+def make_step(net, step_size=1.5, end='inception_4c/output', jitter=32, clip=True, objective=objective_L2, lean=False):
     '''Basic gradient ascent step.'''
 
-    src = net.blobs['data']  # input image is stored in Net's 'data' blob
-    dst = net.blobs[end]
+    src = net.input
+    img = src.data[0]
+    scratch = net.buffer('step', img.shape, lean)
 
+    t = time.time()
     ox, oy = np.random.randint(-jitter, jitter + 1, 2)
-    src.data[0] = np.roll(np.roll(src.data[0], ox, -1), oy, -2)  # apply jitter shift
+    img[:] = roll(img, ox, oy, scratch)  # apply jitter shift
+    t = profiler.lap('jitter', t)
 
-    net.forward(end=end)
+    dst = net.forward(end)
+    t = profiler.lap('forward', t)
     objective(dst)  # specify the optimization objective
-    net.backward(start=end)
+    t = profiler.lap('objective', t)
+    net.backward(end)
+    t = profiler.lap('backward', t)
     g = src.diff[0]
     # apply normalized ascent step to the input image
-    src.data[:] += step_size / np.abs(g).mean() * g
-    src.data[0] = np.roll(np.roll(src.data[0], -ox, -1), -oy, -2)  # unshift image
+    np.abs(g, out=scratch)
+    img += np.multiply(g, step_size / scratch.mean(), out=scratch)
+    img[:] = roll(img, -ox, -oy, scratch)  # unshift image
+    t = profiler.lap('step', t)
 
     if clip:
-        bias = net.transformer.mean['data']
-        src.data[:] = np.clip(src.data, -bias, 255 - bias)
+        bias = net.mean
+        np.clip(img, -bias, 255 - bias, out=img)
+        profiler.lap('clip', t)
 
 
-def deepdream(net, base_img, iter_n=10, octave_n=4, step_size=1.5, octave_scale=1.4, jitter=32,
-              end='inception_4c/output', clip=True, **step_params):
-    # prepare base images for all octaves
-    octaves = [preprocess(net, base_img)]
-    for i in xrange(octave_n - 1):
-        octaves.append(nd.zoom(octaves[-1], (1, 1.0 / octave_scale, 1.0 / octave_scale), order=1))
+def draftOctaves(octaves, draft):
+    # octaves to dream, smallest first. a draft dreams its draft smallest octaves only, then goes
+    # straight to full size, where the details of the small octaves are upscaled onto the frame
+    dreamed = octaves[::-1]
+    if draft and draft < len(octaves):
+        dreamed = dreamed[:draft] + [octaves[0]]
+    return dreamed
+
 
-    src = net.blobs['data']
-    detail = np.zeros_like(octaves[-1])  # allocate image for network-produced details
-    for octave, octave_base in enumerate(octaves[::-1]):
+def deepdream(net, base_img, iter_n=10, octave_n=4, step_size=1.5, octave_scale=1.4, jitter=32,
+              end='inception_4c/output', clip=True, tile=None, debug=False, draft=None, draft_iter=0, lean=False,
+              **step_params):
+    # draft: dream only this many of the smallest octaves, and draft_iter iterations at full size.
+    # lean: keep only the buffers of the octave being dreamed, the smaller octaves are dropped once dreamed
+    # prepare base images for all octaves, in buffers the next frames of the same size reuse
+    t = time.time()
+    shapes = octaveShapes(base_img.shape[0], base_img.shape[1], octave_n, octave_scale)
+    octaves = [net.buffer(('octave', 0), (3,) + shapes[0], lean)]
+    octaves[0][:] = np.rollaxis(base_img, 2)[::-1]  # preprocess in place
+    octaves[0] -= net.mean
+    for octave, (h, w) in enumerate(shapes[1:]):
+        out = np.empty((3, h, w), np.float32) if lean else net.buffer(('octave', octave + 1), (3, h, w))
+        octaves.append(resize(octaves[-1], h, w, out))
+    t = profiler.lap('octaves', t)
+
+    detail = net.buffer('detail', (3,) + shapes[-1], lean)  # image for network-produced details
+    detail[:] = 0
+    dreamed = draftOctaves(octaves, draft)
+    del octaves
+    for octave in xrange(len(dreamed)):
+        octave_base = dreamed[octave]
+        if lean:
+            dreamed[octave] = None  # freed once dreamed
+        profiler.octave = octave
         h, w = octave_base.shape[-2:]
-        if octave > 0:
+        if detail.shape[-2:] != (h, w):
             # upscale details from the previous octave
-            h1, w1 = detail.shape[-2:]
-            detail = nd.zoom(detail, (1, 1.0 * h / h1, 1.0 * w / w1), order=1)
-
-        src.reshape(1, 3, h, w)  # resize the network's input image size
-        src.data[0] = octave_base + detail
+            detail = resize(detail, h, w, net.buffer('detail', (3, h, w), lean))
+            t = profiler.lap('upscale', t)
+        if draft and draft < len(shapes) and octave == draft:
+            iter_n = draft_iter  # full size after a draft
+
+        if tile and max(h, w) > tile:
+            # octave larger than a tile: the net only ever sees one tile at a time
+            img = np.add(octave_base, detail, out=net.buffer('tiled', (3, h, w), lean))
+            for i in xrange(iter_n):
+                make_step_tiled(net, img, tile, end=end, step_size=step_size, jitter=jitter, clip=clip, lean=lean,
+                                **step_params)
+                if debug:
+                    print octave, i, end, img.shape[::-1], 'tiled'
+            np.subtract(img, octave_base, out=detail)
+            result = img
+            t = time.time()
+            continue
+
+        net.reshape(1, h, w)  # resize the network's input image size
+        src = net.input
+        np.add(octave_base, detail, out=src.data[0])
         for i in xrange(iter_n):
-            make_step(net, end=end, step_size=step_size, jitter=jitter, clip=clip, **step_params)
+            make_step(net, end=end, step_size=step_size, jitter=jitter, clip=clip, lean=lean, **step_params)
 
-            # visualization
-            vis = deprocess(net, src.data[0])
-            if not clip:  # adjust image contrast if clipping is disabled
-                vis = vis * (255.0 / np.percentile(vis, 99.98))
-            print octave, i, end, vis.shape
+            if debug:
+                # visualization
+                vis = deprocess(net, src.data[0])
+                if not clip:  # adjust image contrast if clipping is disabled
+                    vis = vis * (255.0 / np.percentile(vis, 99.98))
+                print octave, i, end, vis.shape
 
         # extract details produced on the current octave
-        detail = src.data[0] - octave_base
+        np.subtract(src.data[0], octave_base, out=detail)
+        result = src.data[0]
+        t = time.time()
+    profiler.octave = None
     # returning the resulting image
-    return deprocess(net, src.data[0])
+    return deprocess(net, result)
+
+
+def benchmarkCore(frame, octave_n, octave_scale, jitter, iter_n=10, steps=20):
+    # time spent per iteration outside the network, at every octave size of frame
+    net = NullBackend()
+    print 'octave      size  us/iteration'
+    for octave, (h, w) in enumerate(octaveShapes(frame.shape[0], frame.shape[1], octave_n, octave_scale)[::-1]):
+        net.reshape(1, h, w)
+        net.input.data[:] = np.random.uniform(-100, 100, (3, h, w))
+        make_step(net, end='data', jitter=jitter)  # warm up
+        now = time.time()
+        for i in xrange(steps):
+            make_step(net, end='data', jitter=jitter)
+        print '%6d %9s %13.0f' % (octave, '%dx%d' % (w, h), 1e6 * (time.time() - now) / steps)
+
+    deepdream(net, frame, iter_n=iter_n, octave_n=octave_n, octave_scale=octave_scale, jitter=jitter, end='data')
+    now = time.time()
+    deepdream(net, frame, iter_n=iter_n, octave_n=octave_n, octave_scale=octave_scale, jitter=jitter, end='data')
+    print 'Whole frame without the network: %.1f ms (%d iterations per octave)' % (1e3 * (time.time() - now), iter_n)
+
+
+# Tiled dreaming: peak memory depends on the tile size, not on the frame size.
+
+def make_step_tiled(net, img, tile, step_size=1.5, end='inception_4c/output', jitter=32, clip=True,
+                    objective=objective_L2, lean=False):
+    '''Gradient ascent step on an image larger than the net input, one tile at a time.'''
+
+    h, w = img.shape[-2:]
+    margin = tile // 4
+    g = net.buffer('tiledstep', img.shape, lean)
+    # random grid offset on top of the jitter, so tile edges land somewhere else every step
+    t = time.time()
+    ox, oy = np.random.randint(-jitter, jitter + 1, 2) + np.random.randint(0, tile, 2)
+    img[:] = roll(img, ox, oy, g)  # apply jitter shift
+    t = profiler.lap('jitter', t)
+
+    for y in xrange(0, h, tile):
+        for x in xrange(0, w, tile):
+            # each tile is seen with margin pixels of context around it, only its own gradient is kept
+            y0, y1 = max(y - margin, 0), min(y + tile + margin, h)
+            x0, x1 = max(x - margin, 0), min(x + tile + margin, w)
+            net.reshape(1, y1 - y0, x1 - x0)
+            src = net.input
+            src.data[0] = img[:, y0:y1, x0:x1]
+            t = profiler.lap('tiles', t)
+            dst = net.forward(end)
+            t = profiler.lap('forward', t)
+            objective(dst)  # specify the optimization objective
+            t = profiler.lap('objective', t)
+            net.backward(end)
+            t = profiler.lap('backward', t)
+            g[:, y:y + tile, x:x + tile] = src.diff[0][:, y - y0:y - y0 + tile, x - x0:x - x0 + tile]
+            t = profiler.lap('tiles', t)
+
+    # apply normalized ascent step to the whole image
+    img += g * (step_size / np.abs(g).mean())
+    img[:] = roll(img, -ox, -oy, g)  # unshift image
+    t = profiler.lap('step', t)
+
+    if clip:
+        bias = net.mean
+        np.clip(img, -bias, 255 - bias, out=img)
+        profiler.lap('clip', t)
+
+
+def forkedCase(case):
+    # result of case() run in a fresh forked process, so peak RSS is not carried over from one case to the next.
+    # None when the case failed: it raised (MemoryError is what the memory benchmarks probe) or was killed
+    results = multiprocessing.Queue()
+
+    def run():
+        try:
+            results.put(case())
+        except BaseException as error:
+            print 'Case failed: %r' % error
+            results.put(None)
+
+    child = multiprocessing.Process(target=run)
+    child.start()
+    while True:
+        try:
+            result = results.get(timeout=1)
+            break
+        except Queue.Empty:
+            if child.exitcode is not None:
+                # died without a result, the OOM killer does that. one last look for a result in flight
+                try:
+                    result = results.get(timeout=1)
+                except Queue.Empty:
+                    print 'Case died with exit code %d' % child.exitcode
+                    result = None
+                break
+    child.join()
+    return result
+
+
+def benchmarkTiles(net, frame, end, cases, sizes=((1920, 1080), (3840, 2160))):
+    # seconds and peak RSS to dream frame at 1080p and 4K, for every (label, getFrame) case,
+    # every case in a fresh forked process
+    print 'baseline RSS %d MB' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024)
+    rows = []
+    for width, height in sizes:
+        img = np.float32(PIL.Image.fromarray(np.uint8(frame)).resize((width, height), PIL.Image.BICUBIC))
+        for label, getFrame in cases:
+
+            def run():
+                now = time.time()
+                getFrame(net, img, end)
+                return time.time() - now, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024
+
+            rows.append((width, height, label, forkedCase(run)))
+
+    print 'resolution      tile    s/frame  peak RSS'
+    for width, height, label, result in rows:
+        if result is None:
+            print '%10s %9s     failed/OOM' % ('%dx%d' % (width, height), label)
+        else:
+            print '%10s %9s %10.2f %6d MB' % (('%dx%d' % (width, height), label) + result)
+
+
+def previewGetFrame(getFrame, scale):
+    # getFrame dreaming a frame scale times smaller and upscaling the dream, what --preview shows
+    def dream(net, frame, endparam):
+        h, w = frame.shape[:2]
+        small = np.float32(PIL.Image.fromarray(np.uint8(frame)).resize((w // scale, h // scale), PIL.Image.ANTIALIAS))
+        hallu = np.clip(getFrame(net, small, endparam), 0, 255)
+        return np.float32(PIL.Image.fromarray(np.uint8(hallu)).resize((w, h), PIL.Image.BICUBIC))
+    return dream
+
+
+def benchmarkDraft(net, frames, end, cases):
+    # seconds per frame of every (label, getFrame) case, and how close its dreams come to the first
+    # case, the full render: PSNR of the frames, and correlation of the details (dream minus input)
+    results = []
+    for label, getFrame in cases:
+        np.random.seed(0)  # same jitter for every case
+        now = time.time()
+        dreams = [np.clip(getFrame(net, frame, end), 0, 255) for frame in frames]
+        results.append((label, (time.time() - now) / len(frames), dreams))
+
+    full = results[0]
+    print 'case               s/frame  speedup    PSNR  detail corr'
+    for label, seconds, dreams in results:
+        mse = np.mean([np.square(dream - reference).mean() for dream, reference in zip(dreams, full[2])])
+        psnr = 10 * math.log10(255.0 ** 2 / mse) if mse > 0 else float('inf')
+        corr = np.mean([np.corrcoef((dream - frame).ravel(), (reference - frame).ravel())[0, 1]
+                        for dream, reference, frame in zip(dreams, full[2], frames)])
+        print '%-18s %8.2f %7.2fx %7.2f %12.3f' % (label, seconds, full[1] / max(seconds, 1e-9), psnr, corr)
+
+
+class LastFrameWriter(object):
+    # keeps the last frame written, for benchmarkMemory
+    def name(self, index):
+        return 'frame %d' % index
+
+    def write(self, index, frame, done=None):
+        self.frame = np.uint8(frame)
+
+    def close(self):
+        pass
+
+
+def benchmarkMemory(net, frames, end, makeGetFrame, sizes=((640, 360), (1280, 720), (1920, 1080)), tolerance=30.0):
+    # peak RSS of dreaming frames with flow at 360p, 720p and 1080p, float32 against --lean, every case in a
+    # fresh forked process like benchmarkTiles. a forked process starts with the RSS of its parent, so the growth
+    # over that is shown as well. the last lean frame must stay within tolerance (PSNR) of the float32 one
+    print 'baseline RSS %d MB' % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024)
+    rows = []
+    for width, height in sizes:
+        imgs = [np.float32(PIL.Image.fromarray(np.uint8(frame)).resize((width, height), PIL.Image.BICUBIC))
+                for frame in frames]
+        last = {}
+        for lean in (False, True):
+
+            def run():
+                np.random.seed(0)  # same jitter for both cases
+                writer = LastFrameWriter()
+                start = memoryUsage()[0]
+                now = time.time()
+                dreamFrames(net, [(index, 'frame %d' % index, img) for index, img in enumerate(imgs)], writer,
+                            makeGetFrame(lean), len(imgs), [end], 0, 1, lean=lean)
+                seconds = time.time() - now
+                peak = memoryUsage()[1]
+                return seconds / len(imgs), peak, peak - start if start is not None else None, writer.frame
+
+            result = forkedCase(run)
+            if result is not None:
+                last[lean] = result[-1]
+                result = result[:-1]
+            rows.append((width, height, lean, result))
+        if len(last) == 2:
+            mse = np.square(np.float32(last[True]) - last[False]).mean()
+            rows.append(10 * math.log10(255.0 ** 2 / mse) if mse > 0 else float('inf'))
+
+    print 'resolution      state    s/frame  peak RSS    growth   PSNR'
+    for row in rows:
+        if not isinstance(row, tuple):
+            print '%59.1f %s' % (row, 'ok' if row >= tolerance else 'OVER TOLERANCE (%.0f dB)' % tolerance)
+            continue
+        width, height, lean, result = row
+        if result is None:
+            print '%10s %10s     failed/OOM' % ('%dx%d' % (width, height), 'lean' if lean else 'float32')
+            continue
+        seconds, rss, growth = result
+        print '%10s %10s %10.2f %6d MB %6s MB' % ('%dx%d' % (width, height), 'lean' if lean else 'float32', seconds,
+                                                 rss, '-' if growth is None else '%d' % growth)
+
+
+# Batched dreaming: several same-size frames go through the net as one blob, so every
+# forward/backward runs larger GEMMs and the per-call overhead is shared by the batch.
+
+def make_step_batch(net, step_size=1.5, end='inception_4c/output', jitter=32, clip=True, objective=objective_L2):
+    '''Gradient ascent step on every image of the input batch at once.'''
+
+    src = net.input
+    scratch = net.buffer('step', src.data.shape[1:])
+
+    t = time.time()
+    shifts = np.random.randint(-jitter, jitter + 1, (len(src.data), 2))
+    for n, (ox, oy) in enumerate(shifts):
+        src.data[n] = roll(src.data[n], ox, oy, scratch)  # apply jitter shift, per image
+    t = profiler.lap('jitter', t)
+
+    dst = net.forward(end)
+    t = profiler.lap('forward', t)
+    objective(dst)  # specify the optimization objective
+    t = profiler.lap('objective', t)
+    net.backward(end)
+    t = profiler.lap('backward', t)
+    for n, (ox, oy) in enumerate(shifts):
+        img, g = src.data[n], src.diff[n]
+        # normalize the ascent step of each image on its own gradient, as a batch of 1 would
+        np.abs(g, out=scratch)
+        img += np.multiply(g, step_size / scratch.mean(), out=scratch)
+        img[:] = roll(img, -ox, -oy, scratch)  # unshift image
+    t = profiler.lap('step', t)
+
+    if clip:
+        bias = net.mean
+        np.clip(src.data, -bias, 255 - bias, out=src.data)
+        profiler.lap('clip', t)
+
+
+def deepdream_batch(net, base_imgs, iter_n=10, octave_n=4, step_size=1.5, octave_scale=1.4, jitter=32,
+                    end='inception_4c/output', clip=True, debug=False, draft=None, draft_iter=0, **step_params):
+    # prepare base images for all octaves, the whole batch at once
+    t = time.time()
+    n = len(base_imgs)
+    shapes = octaveShapes(base_imgs[0].shape[0], base_imgs[0].shape[1], octave_n, octave_scale)
+    octaves = [net.buffer(('octaves', 0), (n, 3) + shapes[0])]
+    for octave_base, base_img in zip(octaves[0], base_imgs):
+        octave_base[:] = np.rollaxis(base_img, 2)[::-1]  # preprocess in place
+    octaves[0] -= net.mean
+    for octave, (h, w) in enumerate(shapes[1:]):
+        octaves.append(resize(octaves[-1], h, w, net.buffer(('octaves', octave + 1), (n, 3, h, w))))
+    t = profiler.lap('octaves', t)
+
+    detail = net.buffer('details', (n, 3) + shapes[-1])  # images for network-produced details
+    detail[:] = 0
+    dreamed = draftOctaves(octaves, draft)
+    for octave, octave_base in enumerate(dreamed):
+        profiler.octave = octave
+        h, w = octave_base.shape[-2:]
+        if detail.shape[-2:] != (h, w):
+            # upscale details from the previous octave
+            detail = resize(detail, h, w, net.buffer('details', (n, 3, h, w)))
+            t = profiler.lap('upscale', t)
+        if draft and draft < len(octaves) and octave == draft:
+            iter_n = draft_iter  # full size after a draft
+
+        net.reshape(n, h, w)  # resize the network's input to the batch
+        src = net.input
+        np.add(octave_base, detail, out=src.data)
+        for i in xrange(iter_n):
+            make_step_batch(net, end=end, step_size=step_size, jitter=jitter, clip=clip, **step_params)
+            if debug:
+                print octave, i, end, src.data.shape
+
+        # extract details produced on the current octave
+        np.subtract(src.data, octave_base, out=detail)
+        t = time.time()
+    profiler.octave = None
+    # returning the resulting images
+    return [deprocess(net, img) for img in src.data]
+
+
+def benchmarkBatch(net, frame, end, octave_n, octave_scale, sizes=(1, 2, 4, 8), steps=3):
+    # steps/s and frames/s of make_step_batch at every octave size deepdream would use for frame
+    shapes = octaveShapes(frame.shape[0], frame.shape[1], octave_n, octave_scale)
+    print 'octave      size  batch  frames/s   speedup'
+    for octave, (h, w) in enumerate(shapes[::-1]):
+        octave_base = preprocess(net, nd.zoom(frame, (1.0 * h / frame.shape[0], 1.0 * w / frame.shape[1], 1), order=1))
+        single = None
+        for size in sizes:
+            net.reshape(size, h, w)
+            net.input.data[:] = octave_base
+            make_step_batch(net, end=end)  # warm up
+            now = time.time()
+            for i in xrange(steps):
+                make_step_batch(net, end=end)
+            fps = size * steps / max(time.time() - now, 1e-6)
+            single = single or fps
+            print '%6d %9s %6d %9.2f %8.2fx' % (octave, '%dx%d' % (w, h), size, fps, fps / single)
 
 
 # Animaton functions
@@ -103,6 +768,24 @@ def morphPicture(filename1, filename2, blend, width):
     return PIL.Image.blend(img1, img2, blend)
 
 
+def blendFrames(frame1, frame2, blend):
+    # same as morphPicture, but on frames already in memory
+    img1 = PIL.Image.fromarray(np.uint8(frame1))
+    img2 = PIL.Image.fromarray(np.uint8(frame2))
+    return np.float32(PIL.Image.blend(img1, img2, blend))
+
+
+def loadFrame(filename, preview=0):
+    if preview is not 0:
+        return np.float32(resizePicture(filename, preview))
+    return np.float32(PIL.Image.open(filename))
+
+
+def listFrames(inputdir):
+    # png frames of a directory, in frame order
+    return sorted(frame for frame in os.listdir(inputdir) if ".png" in frame)
+
+
 def make_sure_path_exists(path):
     # make sure input and output directory exist, if not create them. If another error (permission denied) throw an error.
     try:
@@ -112,301 +795,1734 @@ def make_sure_path_exists(path):
             raise
 
 
-def main(inputdir, outputdir, modeldir, preview, octaves, octave_scale, iterations, jitter, zoom, stepsize, blend, layers, guide,
-         gpu, flow, binocular):
-    # input var setup
-    make_sure_path_exists(inputdir)
-    make_sure_path_exists(outputdir)
-    if modeldir is None: modeldir = '../../caffe/models/'
-    if preview is None: preview = 0
-    if octaves is None: octaves = 4
-    if octave_scale is None: octave_scale = 1.5
-    if iterations is None: iterations = 10
-    if jitter is None: jitter = 32
-    if jitter is None: jitter = 32
-    if zoom is None: zoom = 1
-    if stepsize is None: stepsize = 1.5
-    if blend is None: blend = 0.5
-    if layers is None: layers = ['inception_4c/output']
-    if gpu is None: gpu = 1
-    if flow is None: flow = 0
-    if binocular is None: binocular = 0
-    # net.blobs.keys()
+# Farneback settings of every flow field, part of the flow cache key
+FARNEBACK = dict(pyr_scale=0.5, levels=3, winsize=15, iterations=3, poly_n=5, poly_sigma=1.2, flags=0)
 
-    # Loading DNN model
-    model_name = 'bvlc_googlenet'
-    model_path = os.path.join(modeldir, model_name)
-    net_fn = os.path.join(model_path, 'deploy.prototxt')
-    param_fn = os.path.join(model_path, 'bvlc_googlenet.caffemodel')
 
-    # Patching model to be able to compute gradients.
-    # Note that you can also manually add "force_backward: true" line to "deploy.prototxt".
-    model = caffe.io.caffe_pb2.NetParameter()
-    text_format.Merge(open(net_fn).read(), model)
-    model.force_backward = True
-    open('tmp.prototxt', 'w').write(str(model))
+def opticalFlow(previousGrayImg, grayImg, flowcache=None):
+    # dense flow from grayImg back to previousGrayImg, as a map usable by cv2.remap
+    flow = -np.float32(cachedFlow(previousGrayImg, grayImg, flowcache))
+    h, w = flow.shape[:2]
+    flow[:, :, 0] += np.arange(w)
+    flow[:, :, 1] += np.arange(h)[:, np.newaxis]
+    return flow
 
-    net = caffe.Classifier('tmp.prototxt', param_fn,
-                           mean=np.float32([104.0, 116.0, 122.0]),  # ImageNet mean, training set dependent
-                           channel_swap=(2, 1, 0))  # the reference model has channels in BGR order instead of RGB
 
-    if gpu is 1:
-        caffe.set_mode_gpu()
-        caffe.set_device(0)
+def saveCached(filename, array):
+    # write a cache entry through a temporary file unique to the process and thread, so readers never see half
+    # an entry. threads and processes storing the same key race harmlessly, the entries are identical
+    tmp = '%s.%d.%d.tmp' % (filename, os.getpid(), threading.current_thread().ident)
+    with open(tmp, 'wb') as f:
+        np.save(f, array)
+    try:
+        os.rename(tmp, filename)
+    except OSError:
+        os.remove(tmp)
+        if not os.path.exists(filename):
+            raise
 
-    # load images & sort them
+
+def cachedFlow(previousGrayImg, grayImg, flowcache=None):
+    # raw Farneback flow, read from or stored in the flow cache directory when one is given.
+    # fields only depend on the two frames, so they are shared by any dream settings.
+    import cv2
+    if flowcache is None:
+        return cv2.calcOpticalFlowFarneback(previousGrayImg, grayImg, None, **FARNEBACK)
+
+    key = hashlib.sha1()
+    for gray in (previousGrayImg, grayImg):
+        key.update(str(gray.shape))
+        key.update(hashlib.sha1(np.ascontiguousarray(gray)).digest())
+    key.update(json.dumps(FARNEBACK, sort_keys=True))
+    key = key.hexdigest()
+    filename = os.path.join(flowcache, key[:2], key + '.npy')
+    if os.path.exists(filename):
+        return np.load(filename, mmap_mode='r')
+
+    # displacements, half precision is plenty. return the stored values so cold and warm runs match
+    flow = cv2.calcOpticalFlowFarneback(previousGrayImg, grayImg, None, **FARNEBACK).astype(np.float16)
+    make_sure_path_exists(os.path.dirname(filename))
+    saveCached(filename, flow)
+    return flow
+
+
+def flowPair(task):
+    previousframe, frame, preview, flowcache = task
+    cachedFlow(grayFrame(loadFrame(previousframe, preview)), grayFrame(loadFrame(frame, preview)), flowcache)
+
+
+def precomputeFlow(inputdir, flowcache, preview, binocular, workers):
+    # fill the flow cache for every frame pair a later --flow run will need, on all cores
+    if preview is None: preview = 0
+    if workers is None: workers = multiprocessing.cpu_count()
     if binocular is 1:
-        vidinput_left  = os.listdir(os.path.join(inputdir, 'Left'))
-        vidinput_right = os.listdir(os.path.join(inputdir, 'Right'))
-        vids = [[],[]]
-        for frame in vidinput_left:
-            if not ".png" in frame: continue
-            vids[0].append(frame)
-        for frame in vidinput_right:
-            if not ".png" in frame: continue
-            vids[1].append(frame)
-        assert(len(vids[0]) == len(vids[1]), 'Left and right videos must have same number of frames')
-        frame0 = vids[0][0]
-        numframe = len(vids[0])
+        left, right = os.path.join(inputdir, 'Left'), os.path.join(inputdir, 'Right')
+        vidsLeft, vidsRight = listFrames(left), listFrames(right)
+        pairs = [(os.path.join(left, a), os.path.join(left, b)) for a, b in zip(vidsLeft, vidsLeft[1:])]
+        pairs += [(os.path.join(right, a), os.path.join(right, b)) for a, b in zip(vidsRight, vidsRight[1:])]
+        pairs += [(os.path.join(left, a), os.path.join(right, b)) for a, b in zip(vidsLeft, vidsRight)]
     else:
-        vidinput = os.listdir(inputdir)
-        #vidinput = natsort.natsorted(os.listdir(inputdir))
-        vids = []
-        # create list
-        for frame in vidinput:
-            if not ".png" in frame: continue
-            vids.append(frame)
-        frame0 = vids[0]
-        numframe = len(vids)
-
-        img = PIL.Image.open(os.path.join(inputdir, frame0))
-        if preview is not 0:
-            img = resizePicture(os.path.join(inputdir, frame0), preview)
-        frame = np.float32(img)
+        vids = listFrames(inputdir)
+        pairs = [(os.path.join(inputdir, a), os.path.join(inputdir, b)) for a, b in zip(vids, vids[1:])]
 
-    var_counter = 1
+    now = time.time()
+    pool = multiprocessing.Pool(workers)
+    try:
+        for count, _ in enumerate(pool.imap_unordered(flowPair, [pair + (preview, flowcache) for pair in pairs])):
+            print 'Flow ' + str(count + 1) + ' of ' + str(len(pairs))
+    finally:
+        pool.close()
+        pool.join()
+    print 'Computed %d flow fields in %.1fs' % (len(pairs), time.time() - now)
 
-    # guide
-    if guide is not None:
-        guideimg = PIL.Image.open(os.path.join(inputdir, guide))
-        guideimgresized = guideimg.resize((224, 224), PIL.Image.ANTIALIAS)
-        guide = np.float32(guideimgresized)
-        end = layers[0]  # 'inception_3b/output'
-        h, w = guide.shape[:2]
-        src, dst = net.blobs['data'], net.blobs[end]
-        src.reshape(1, 3, h, w)
-        src.data[0] = preprocess(net, guide)
-        net.forward(end=end)
-        guide_features = dst.data[0].copy()
 
-    def objective_guide(dst):
-        x = dst.data[0].copy()
-        y = guide_features
-        ch = x.shape[0]
-        x = x.reshape(ch, -1)
-        y = y.reshape(ch, -1)
-        A = x.T.dot(y)  # compute the matrix of dot-products with guide features
-        dst.diff[0].reshape(ch, -1)[:] = y[:, A.argmax(1)]  # select ones that match best
+def warpDream(hallu, previousImg, img, flow):
+    # carry the dream of the previous frame onto the current one
+    import cv2
+    halludiff = hallu - previousImg
+    halludiff = cv2.remap(halludiff, flow, None, cv2.INTER_LINEAR)
+    return img + halludiff
+
+
+# Lean frame state: with --lean, what a frame hands to the next is stored compact, in arrays reused every frame.
+# with flow, the dream details are int16 fixed point and the input uint8 (input frames are whole numbers),
+# without flow the dream is uint8, all blendFrames looks at. flow maps are OpenCV's fixed point maps
+
+DETAIL_SCALE = 64.0  # int16 steps per level of the carried dream details
+
 
-    def getFrame(net, frame, endparam):
-        # dream frame
-        if guide is None:
-            return deepdream(net, frame, iter_n=iterations, step_size=stepsize, octave_n=octaves,
-                             octave_scale=octave_scale, jitter=jitter, end=endparam)
+def compactState(hallu, img, flow, buffers):
+    # (dream, input) of a frame as the next frame needs them, in the arrays of buffers. hallu is overwritten
+    def buffer(name, dtype):
+        if name not in buffers or buffers[name].shape != img.shape:
+            buffers[name] = np.empty(img.shape, dtype)
+        return buffers[name]
+
+    previousImg = buffer('img', np.uint8)
+    np.copyto(previousImg, img, casting='unsafe')
+    if flow is not 1:
+        dream = buffer('dream', np.uint8)
+        np.copyto(dream, hallu, casting='unsafe')
+        return dream, previousImg
+    hallu -= img
+    hallu *= DETAIL_SCALE
+    np.rint(hallu, out=hallu)
+    detail = buffer('detail', np.int16)
+    np.copyto(detail, hallu, casting='unsafe')
+    return detail, previousImg
+
+
+def compactFlow(flowmap):
+    # a remap map as OpenCV's fixed point pair: 6 bytes per pixel instead of 8, and a faster remap
+    import cv2
+    return cv2.convertMaps(flowmap, None, cv2.CV_16SC2)
+
+
+def warpDetail(detail, img, maps):
+    # warpDream on the compact state: img plus the int16 details of the previous frame, carried along compact maps
+    import cv2
+    warped = cv2.remap(detail, maps[0], maps[1], cv2.INTER_LINEAR)
+    return img + warped * np.float32(1 / DETAIL_SCALE)
+
+
+# Adaptive schedule: motion (mean flow length, pixels) and residual (mean error of the previous
+# frame warped onto the current one, 0-255) at which a frame gets every iteration
+ADAPTIVE_MOTION = 4.0
+ADAPTIVE_RESIDUAL = 20.0
+
+
+def frameChange(previousImg, img, flow):
+    # how much the scene moved, and how much the warp failed to explain (occlusions, cuts)
+    import cv2
+    h, w = flow.shape[:2]
+    motion = np.hypot(flow[:, :, 0] - np.arange(w), flow[:, :, 1] - np.arange(h)[:, np.newaxis]).mean()
+    residual = np.abs(cv2.remap(previousImg, flow, None, cv2.INTER_LINEAR) - img).mean()
+    return motion, residual
+
+
+def adaptiveIterations(iterations, quality, motion, residual):
+    # the warped dream carries most of a static shot, so it needs a few touch-up iterations only.
+    # quality is the share of iterations every frame gets, scene cuts get them all.
+    change = min(max(motion / ADAPTIVE_MOTION, residual / ADAPTIVE_RESIDUAL), 1.0)
+    return max(1, int(round(iterations * (quality + (1 - quality) * change))))
+
+
+def logSchedule(schedulelog, index, motion, residual, iterations):
+    print 'Schedule: %d iterations (motion %.2fpx, residual %.2f)' % (iterations, motion, residual)
+    if schedulelog is None:
+        return
+    open(schedulelog, 'a').write('%d,%.4f,%.4f,%d\n' % (index, motion, residual, iterations))
+
+
+def startSchedule(schedulelog, last=-1):
+    # a run starts the log over, a resumed one keeps the rows of the frames up to last
+    rows = []
+    if last >= 0 and os.path.exists(schedulelog):
+        rows = [line for line in open(schedulelog).readlines()[1:] if int(line.split(',')[0]) <= last]
+    open(schedulelog, 'w').write('frame,motion,residual,iterations\n' + ''.join(rows))
+
+
+def grayFrame(img):
+    import cv2
+    return cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+
+
+# Frame sources and writers
+
+def readDirectory(inputdir, vids, preview, start=0, stop=None):
+    for index in xrange(start, len(vids) if stop is None else stop):
+        filename = os.path.join(inputdir, vids[index])
+        yield index, filename, loadFrame(filename, preview)
+
+
+def probeVideo(filename):
+    # width, height, framerate and frame count (0 if unknown) of the first video stream
+    output = subprocess.check_output(['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries',
+                                      'stream=width,height,r_frame_rate,nb_frames',
+                                      '-of', 'default=noprint_wrappers=1', filename])
+    info = dict(line.split('=', 1) for line in output.splitlines() if '=' in line)
+    num, _, den = info['r_frame_rate'].partition('/')
+    framerate = float(num) / float(den or 1)
+    numframe = int(info['nb_frames']) if info.get('nb_frames', '').isdigit() else 0
+    return int(info['width']), int(info['height']), framerate, numframe
+
+
+def readVideo(filename, width, height, buffersize):
+    # decode frames from an ffmpeg rawvideo pipe, keeping at most buffersize frames in flight
+    framesize = width * height * 3
+    process = subprocess.Popen(['ffmpeg', '-v', 'error', '-i', filename, '-vf', 'scale=%d:%d' % (width, height),
+                                '-f', 'rawvideo', '-pix_fmt', 'rgb24', '-'],
+                               stdout=subprocess.PIPE, bufsize=framesize)
+    frames = Queue.Queue(maxsize=buffersize)
+
+    def decode():
+        index = 0
+        while True:
+            data = process.stdout.read(framesize)
+            if len(data) < framesize:
+                break
+            frame = np.frombuffer(data, np.uint8).reshape(height, width, 3)
+            frames.put((index, '%s [frame %d]' % (filename, index), np.float32(frame)))
+            index += 1
+        frames.put(None)
+
+    decoder = threading.Thread(target=decode)
+    decoder.daemon = True
+    decoder.start()
+    count = 0
+    while True:
+        item = frames.get()
+        if item is None:
+            break
+        yield item
+        count += 1
+    process.stdout.close()
+    # a decode that fails partway would otherwise end as a short video
+    if process.wait() != 0:
+        raise IOError('ffmpeg failed decoding %s after %d frames' % (filename, count))
+
+
+class PngWriter(object):
+    # compression is the zlib level, 0 (fastest) to 9, PIL's default 6 when None
+    def __init__(self, outputdir, compression=None):
+        self.outputdir = outputdir
+        self.compression = compression
+
+    def name(self, index):
+        return os.path.join(self.outputdir, 'frame_%06d.png' % index)
+
+    def write(self, index, frame, done=None):
+        # done is called once the frame is saved. save to a temporary file first,
+        # so a process killed while saving never leaves a broken frame that --resume takes as done
+        filename = self.name(index)
+        temp = os.path.splitext(filename)[0] + '.tmp'
+        if self.compression is None:
+            PIL.Image.fromarray(np.uint8(frame)).save(temp, 'PNG')
         else:
-            return deepdream(net, frame, iter_n=iterations, step_size=stepsize, octave_n=octaves,
-                             octave_scale=octave_scale, jitter=jitter, end=endparam, objective=objective_guide)
-
-    def getStats(saveframe, var_counter, numframe, difference):
-        # Stats
-        print '***************************************'
-        print 'Saving Image As: ' + saveframe
-        print 'Frame ' + str(var_counter) + ' of ' + str(numframe)
-        print 'Frame Time: ' + str(difference) + 's'
-        timeleft = difference * (numframe - var_counter)
-        m, s = divmod(timeleft, 60)
-        h, m = divmod(m, 60)
-        print 'Estimated Total Time Remaining: ' + str(timeleft) + 's (' + "%d:%02d:%02d" % (h, m, s) + ')'
-        print '***************************************'
+            PIL.Image.fromarray(np.uint8(frame)).save(temp, 'PNG', compress_level=self.compression)
+        os.rename(temp, filename)
+        if done is not None:
+            done()
+
+    def close(self):
+        pass
+
+
+class VideoWriter(object):
+    # encode frames through an ffmpeg stdin pipe, keeping at most buffersize frames in flight
+    def __init__(self, filename, width, height, framerate, buffersize):
+        self.filename = filename
+        self.process = subprocess.Popen(['ffmpeg', '-v', 'error', '-y', '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+                                         '-s', '%dx%d' % (width, height), '-r', str(framerate), '-i', '-',
+                                         '-c:v', 'libx264', '-crf', '20', '-pix_fmt', 'yuv420p',
+                                         '-tune', 'fastdecode', '-tune', 'zerolatency', '-profile:v', 'baseline',
+                                         filename], stdin=subprocess.PIPE)
+        self.frames = Queue.Queue(maxsize=buffersize)
+        self.error = None
+        self.encoder = threading.Thread(target=self.encode)
+        self.encoder.daemon = True
+        self.encoder.start()
+
+    def name(self, index):
+        return '%s [frame %d]' % (self.filename, index)
+
+    def encode(self):
+        # once ffmpeg exits (bad output path, missing codec, full disk) the error is kept for write and close,
+        # and the remaining frames are drained so write never blocks on a full queue
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            if self.error is None:
+                try:
+                    self.process.stdin.write(frame.tostring())
+                except IOError:
+                    self.error = sys.exc_info()
+
+    def check(self):
+        if self.error is not None:
+            raise IOError('ffmpeg failed encoding %s: %s' % (self.filename, self.error[1]))
+        if self.process.poll() is not None:
+            raise IOError('ffmpeg exited encoding %s with code %d' % (self.filename, self.process.returncode))
+
+    def write(self, index, frame, done=None):
+        self.check()
+        self.frames.put(np.uint8(frame))
+        if done is not None:
+            done()
+
+    def close(self):
+        self.frames.put(None)
+        self.encoder.join()
+        try:
+            self.process.stdin.close()
+        except IOError:
+            if self.error is None:
+                self.error = sys.exc_info()
+        if self.process.wait() != 0 or self.error is not None:
+            raise IOError('ffmpeg failed encoding %s%s' % (self.filename, ': %s' % self.error[1] if self.error else ''))
+
+
+# Pipelined I/O: the next frames are read and their flow computed on background threads,
+# and finished frames are saved on others, so the net does not wait on them between frames.
+# PIL's PNG encoder, OpenCV and numpy release the GIL, so threads are enough.
+
+PIPELINE_THREADS = 2  # flow threads, and PNG encoding threads
+
+
+class AsyncWriter(object):
+    # save frames of writer on a thread pool, keeping at most buffersize frames in flight.
+    # done callbacks run on the calling thread in frame order, once the frame and all before it are saved
+    def __init__(self, writer, buffersize, threads=PIPELINE_THREADS):
+        self.writer = writer
+        self.buffersize = buffersize
+        self.pool = ThreadPool(threads)
+        self.pending = collections.deque()
+
+    def name(self, index):
+        return self.writer.name(index)
+
+    def write(self, index, frame, done=None):
+        self.pending.append((self.pool.apply_async(self.writer.write, (index, np.uint8(frame))), done))
+        self.collect(len(self.pending) - self.buffersize)
+
+    def collect(self, wait=0):
+        # wait for the oldest wait frames, and report every frame saved so far
+        while self.pending and (wait > 0 or self.pending[0][0].ready()):
+            result, done = self.pending.popleft()
+            result.get()  # raises the error of a failed save
+            if done is not None:
+                done()
+            wait -= 1
+
+    def close(self):
+        self.collect(len(self.pending))
+        self.pool.close()
+        self.pool.join()
+        self.writer.close()
+
+
+def prefetchFrames(frames, buffersize, flow=0, previousImg=None, flowcache=None, threads=PIPELINE_THREADS):
+    # read up to buffersize frames ahead of the one dreaming. with flow, also convert them to gray
+    # and compute the flow from the frame before, which only depends on the input frames.
+    # yields (index, name, img, gray, flowmap), gray and flowmap None where not computed
+    pool = ThreadPool(threads)
+    items = Queue.Queue(maxsize=buffersize)
+
+    def read():
+        try:
+            previousGrayImg = grayFrame(previousImg) if flow is 1 and previousImg is not None else None
+            for index, name, img in frames:
+                grayImg = flowmap = None
+                if flow is 1:
+                    grayImg = grayFrame(img)
+                    if previousGrayImg is not None:
+                        flowmap = pool.apply_async(opticalFlow, (previousGrayImg, grayImg, flowcache))
+                    previousGrayImg = grayImg
+                items.put((index, name, img, grayImg, flowmap))
+            items.put(None)
+        except Exception:
+            items.put(sys.exc_info())
+
+    reader = threading.Thread(target=read)
+    reader.daemon = True
+    reader.start()
+    try:
+        while True:
+            item = items.get()
+            if item is None:
+                break
+            if len(item) == 3:
+                raise item[0], item[1], item[2]
+            index, name, img, grayImg, flowmap = item
+            yield index, name, img, grayImg, flowmap.get() if flowmap is not None else None
+    finally:
+        pool.close()
 
-    if flow is 1:
-        import cv2
 
-        # optical flow
-        if binocular == 1:
-            imgLeft = np.float32(PIL.Image.open(os.path.join(inputdir, 'Left', frame0)))
-            h, w, c = imgLeft.shape
-            halluLeft = getFrame(net, imgLeft, layers[0])
-            np.clip(halluLeft, 0, 255, out=halluLeft)
-            PIL.Image.fromarray(np.uint8(halluLeft)).save(os.path.join(outputdir, 'Left', 'frame_000000.png'))
-            grayImgLeft = cv2.cvtColor(imgLeft, cv2.COLOR_RGB2GRAY)
-
-            imgRight = np.float32(PIL.Image.open(os.path.join(inputdir, 'Right', vids[1][0])))
-            grayImgRight = cv2.cvtColor(imgRight, cv2.COLOR_RGB2GRAY)
-            flow = cv2.calcOpticalFlowFarneback(grayImgLeft, grayImgRight, pyr_scale=0.5, levels=3, winsize=15,
-                                                iterations=3, poly_n=5, poly_sigma=1.2, flags=0)
-            flow = -flow
-            flow[:, :, 0] += np.arange(w)
-            flow[:, :, 1] += np.arange(h)[:, np.newaxis]
-            halludiff = halluLeft - imgLeft
-            halludiff = cv2.remap(halludiff, flow, None, cv2.INTER_LINEAR)
-            halluRight = imgRight + halludiff
-            halluRight = getFrame(net, halluRight, layers[0])
-            np.clip(halluRight, 0, 255, out=halluRight)
-            PIL.Image.fromarray(np.uint8(halluRight)).save(os.path.join(outputdir, 'Right', 'frame_000000.png'))
-
-            for v in range(numframe):
-                if var_counter < numframe:
-                    previousImgLeft = imgLeft
-                    previousGrayImgLeft = grayImgLeft
-
-                    newframeLeft = os.path.join(inputdir, 'Left', vids[0][v + 1])
-                    print 'Processing: ' + newframeLeft
-                    endparam = layers[var_counter % len(layers)]
-
-                    imgLeft = np.float32(PIL.Image.open(newframeLeft))
-                    grayImgLeft = cv2.cvtColor(imgLeft, cv2.COLOR_RGB2GRAY)
-                    flow = cv2.calcOpticalFlowFarneback(previousGrayImgLeft, grayImgLeft, pyr_scale=0.5, levels=3, winsize=15,
-                                                        iterations=3, poly_n=5, poly_sigma=1.2, flags=0)
-                    flow = -flow
-                    flow[:, :, 0] += np.arange(w)
-                    flow[:, :, 1] += np.arange(h)[:, np.newaxis]
-                    halludiffLeft = halluLeft - previousImgLeft
-                    halludiffLeft = cv2.remap(halludiffLeft, flow, None, cv2.INTER_LINEAR)
-                    halluLeft = imgLeft + halludiffLeft
-
-                    now = time.time()
-                    halluLeft = getFrame(net, halluLeft, endparam)
-                    later = time.time()
-                    difference = int(later - now)
-                    saveframe = os.path.join(outputdir, 'Left', 'frame_%06d.png' % (var_counter))
-                    getStats(saveframe, var_counter, numframe, difference)
-
-                    np.clip(halluLeft, 0, 255, out=halluLeft)
-                    PIL.Image.fromarray(np.uint8(halluLeft)).save(saveframe)
-
-                    previousImgRight = imgRight
-                    previousGrayImgRight = grayImgRight
-
-                    newframeRight = os.path.join(inputdir, 'Right', vids[1][v + 1])
-                    print 'Processing: ' + newframeRight
-                    endparam = layers[var_counter % len(layers)]
-
-                    imgRight = np.float32(PIL.Image.open(newframeRight))
-                    grayImgRight = cv2.cvtColor(imgRight, cv2.COLOR_RGB2GRAY)
-
-                    # Flow from previous frame to current frame
-                    flowPrev = cv2.calcOpticalFlowFarneback(previousGrayImgRight, grayImgRight, pyr_scale=0.5, levels=3, winsize=15,
-                                                        iterations=3, poly_n=5, poly_sigma=1.2, flags=0)
-                    flowPrev = -flowPrev
-                    flowPrev[:, :, 0] += np.arange(w)
-                    flowPrev[:, :, 1] += np.arange(h)[:, np.newaxis]
-                    halludiffRight = halluRight - previousImgRight
-                    halludiffRight = cv2.remap(halludiffRight, flowPrev, None, cv2.INTER_LINEAR)
-
-                    # Flow from left frame to right frame
-                    flowLeft = cv2.calcOpticalFlowFarneback(grayImgLeft, grayImgRight, pyr_scale=0.5, levels=3, winsize=15,
-                                                        iterations=3, poly_n=5, poly_sigma=1.2, flags=0)
-                    flowLeft = -flowLeft
-                    flowLeft[:, :, 0] += np.arange(w)
-                    flowLeft[:, :, 1] += np.arange(h)[:, np.newaxis]
-                    halludiffLeft = halluLeft - imgLeft
-                    halludiffLeft = cv2.remap(halludiffLeft, flowLeft, None, cv2.INTER_LINEAR)
-
-                    halluRight = imgRight + halludiffRight / 2 + halludiffLeft / 2
-
-                    now = time.time()
-                    halluRight = getFrame(net, halluRight, endparam)
-                    later = time.time()
-                    difference = int(later - now)
-                    saveframe = os.path.join(outputdir, 'Right', 'frame_%06d.png' % (var_counter))
-                    getStats(saveframe, var_counter, numframe, difference)
-
-                    np.clip(halluRight, 0, 255, out=halluRight)
-                    PIL.Image.fromarray(np.uint8(halluRight)).save(saveframe)
-
-                    var_counter += 1
+# Profiling
+# with --profile, every stage of every frame is timed into profile.json and profile.csv.
+# stages inside the dream are per octave, octave 0 being the smallest.
+
+ETA_FRAMES = 20  # frame times the estimated time remaining is averaged over
+
+
+def memoryUsage():
+    # current and peak resident memory in MB. current is only known on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    try:
+        rss = int(open('/proc/self/statm').read().split()[1]) * resource.getpagesize() / 1048576.0
+    except (IOError, IndexError, ValueError):
+        rss = None
+    return rss, peak
+
+
+class Profiler(object):
+    def __init__(self):
+        self.enabled = False
+        self.octave = None
+        self.stages = []  # stage names, in the order they first ran
+        self.current = {}
+        self.frames = []
+        self.clock = time.time()
+
+    def start(self):
+        # the next frame record starts now
+        self.current = {}
+        self.clock = time.time()
+
+    def lap(self, stage, start):
+        # add the time since start to stage, and return the time now to time the next stage from
+        now = time.time()
+        if self.enabled:
+            if self.octave is not None:
+                stage = 'octave%d/%s' % (self.octave, stage)
+            if stage not in self.current:
+                self.current[stage] = 0.0
+                if stage not in self.stages:
+                    self.stages.append(stage)
+            self.current[stage] += now - start
+        return now
+
+    def frame(self, index, count=1, warmup=False):
+        # close the record of frame index, or of count frames from index dreamed as a batch.
+        # warm-up frames are dreamed but not saved
+        now = time.time()
+        if self.enabled:
+            rss, peak = memoryUsage()
+            self.frames.append({'frame': index, 'count': count, 'warmup': warmup, 'seconds': now - self.clock,
+                                'rss': rss, 'peak_rss': peak, 'stages': self.current})
+        self.current = {}
+        self.clock = now
+
+    def save(self, basename, params=None):
+        # write basename.json and basename.csv, and print where the time went
+        frames = sorted(self.frames, key=lambda record: record['frame'])
+        totals = dict((stage, sum(record['stages'].get(stage, 0) for record in frames)) for stage in self.stages)
+        report = {'params': params, 'stages': self.stages, 'totals': totals, 'frames': frames,
+                  'seconds': sum(record['seconds'] for record in frames),
+                  'peak_rss': max([record['peak_rss'] for record in frames] or [0])}
+        # time the net sat waiting on everything else: reading, flow, writing
+        report['idle'] = report['seconds'] - sum(totals[stage] for stage in self.stages if stage.startswith('octave'))
+        with open(basename + '.json', 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+        with open(basename + '.csv', 'w') as f:
+            f.write(','.join(['frame', 'count', 'warmup', 'seconds', 'rss', 'peak_rss'] + self.stages) + '\n')
+            for record in frames:
+                row = [record['frame'], record['count'], int(record['warmup']), '%.6f' % record['seconds'],
+                       '' if record['rss'] is None else '%.1f' % record['rss'], '%.1f' % record['peak_rss']]
+                f.write(','.join(map(str, row + ['%.6f' % record['stages'].get(stage, 0) for stage in self.stages])))
+                f.write('\n')
+
+        count = sum(record['count'] for record in frames if not record['warmup'])
+        print 'Profile of %d frames (%s.json, %s.csv):' % (count, basename, basename)
+        print '  %-24s  %9s  %6s' % ('stage', 'seconds', 'share')
+        for stage in sorted(self.stages, key=lambda stage: -totals[stage]):
+            print '  %-24s  %9.3f  %5.1f%%' % (stage, totals[stage], 100 * totals[stage] / max(report['seconds'], 1e-9))
+        print '  dream stage idle %.3fs (%.1f%%)' % (report['idle'], 100 * report['idle'] / max(report['seconds'], 1e-9))
+        print '  peak RSS %.0f MB' % report['peak_rss']
+
+
+profiler = Profiler()
+
+
+def getStats(saveframe, var_counter, numframe, frametimes):
+    # Stats. frametimes holds the seconds of the last frames, the newest last
+    difference = frametimes[-1]
+    average = sum(frametimes) / len(frametimes)
+    print '***************************************'
+    print 'Saving Image As: ' + saveframe
+    print 'Frame ' + str(var_counter) + ' of ' + str(numframe or '?')
+    print 'Frame Time: %.2fs (average of the last %d: %.2fs)' % (difference, len(frametimes), average)
+    timeleft = int(average * max(numframe - var_counter, 0))
+    m, s = divmod(timeleft, 60)
+    h, m = divmod(m, 60)
+    print 'Estimated Total Time Remaining: ' + str(timeleft) + 's (' + "%d:%02d:%02d" % (h, m, s) + ')'
+    print '***************************************'
+
+
+def dreamFrames(net, frames, writer, getFrame, numframe, layers, blend, flow, first=0, previous=None, manifest=None,
+                flowcache=None, adaptive=None, schedulelog=None, prefetch=None, lean=False):
+    # dream a sequence of frames, each one seeded from the dream of the previous one.
+    # frames before index first are only dreamed to warm up the blend chain, not saved.
+    # previous is the (input, dream) pair of the frame before the sequence, to continue a chain.
+    # adaptive is (iterations, quality floor): with flow, frames that barely change get fewer iterations,
+    # the choice is appended to schedulelog.
+    # prefetch is how many frames are read, and their flow computed, ahead on background threads.
+    # lean keeps the previous dream and input compact between frames, see compactState
+    previousImg, hallu = previous or (None, None)
+    buffers = {}
+    if prefetch:
+        frames = prefetchFrames(frames, prefetch, flow, previousImg, flowcache)
+    elif flow is 1 and previousImg is not None:
+        previousGrayImg = grayFrame(previousImg)
+    if lean and hallu is not None:
+        # after the gray frame, which an uninterrupted chain takes from the full precision input
+        hallu, previousImg = compactState(hallu, previousImg, flow, buffers)
+    written = 0
+    frametimes = collections.deque(maxlen=ETA_FRAMES)
+    profiler.start()
+    clock = t = time.time()
+    for item in frames:
+        if prefetch:
+            index, name, img, grayImg, flowmap = item
+            t = profiler.lap('prefetch', t)  # waiting on the prefetch threads only
+        else:
+            index, name, img = item
+            t = profiler.lap('read', t)
+        print 'Processing: ' + name
+        endparam = layers[index % len(layers)]
+
+        iterations = None
+        if flow is 1:
+            if not prefetch:
+                grayImg = grayFrame(img)
+                t = profiler.lap('gray', t)
+            if hallu is not None:
+                if not prefetch:
+                    flowmap = opticalFlow(previousGrayImg, grayImg, flowcache)
+                    t = profiler.lap('flow', t)
+                if lean:
+                    frame = warpDetail(hallu, img, compactFlow(flowmap))
                 else:
-                    print 'Finished processing all frames'
+                    frame = warpDream(hallu, previousImg, img, flowmap)
+                t = profiler.lap('warp', t)
+                if adaptive is not None:
+                    motion, residual = frameChange(previousImg, img, flowmap)
+                    iterations = adaptiveIterations(adaptive[0], adaptive[1], motion, residual)
+                    logSchedule(schedulelog, index, motion, residual, iterations)
+                    t = profiler.lap('schedule', t)
+                flowmap = None
+            else:
+                frame = img
+            previousGrayImg = grayImg
+        elif hallu is not None and blend != 0:
+            frame = blendFrames(hallu, img, blend)
+            t = profiler.lap('blend', t)
         else:
-            img = np.float32(PIL.Image.open(os.path.join(inputdir, frame0)))
-            h, w, c = img.shape
-            hallu = getFrame(net, img, layers[0])
+            frame = img
+        previousImg = img
+
+        hallu = getFrame(net, frame, endparam, iterations)
+        t = time.time()  # the dream records its own stages
+        np.clip(hallu, 0, 255, out=hallu)
+        t = profiler.lap('clip', t)
+        if index < first:
+            if lean:
+                hallu, previousImg = compactState(hallu, img, flow, buffers)
+            profiler.frame(index, warmup=True)
+            clock = t = time.time()
+            continue
+
+        frametimes.append(t - clock)
+        clock = t
+        getStats(writer.name(index), index + 1, numframe, frametimes)
+        saved = None
+        if manifest is not None:
+            state = hallu if flow is 1 or blend != 0 else None
+            if lean and state is not None and isinstance(writer, AsyncWriter):
+                state = hallu.copy()  # compactState overwrites hallu before the deferred save
+            saved = functools.partial(saveManifest, manifest, index, getRandomState(), state)
+        writer.write(index, hallu, saved)
+        t = profiler.lap('write', t)
+        written += 1
+        if lean:
+            hallu, previousImg = compactState(hallu, img, flow, buffers)
+            t = profiler.lap('compact', t)
+        profiler.frame(index)
+    writer.close()
+    return written
+
+
+def dreamBatches(net, frames, writer, getFrame, numframe, layers, batch, manifest=None):
+    # dream independent frames batch at a time. frames of a batch that use another
+    # layer or size than the rest go through the net as a batch of their own.
+    frames = iter(frames)
+    written = 0
+    frametimes = collections.deque(maxlen=ETA_FRAMES)
+    profiler.start()
+    clock = t = time.time()
+    while True:
+        chunk = list(itertools.islice(frames, batch))
+        t = profiler.lap('read', t)
+        if not chunk:
+            break
+        groups = {}
+        for index, name, img in chunk:
+            groups.setdefault((layers[index % len(layers)], img.shape), []).append((index, img))
+
+        dreamed = {}
+        for (endparam, shape), group in groups.items():
+            hallus = getFrame(net, [img for index, img in group], endparam)
+            dreamed.update(zip([index for index, img in group], hallus))
+        t = time.time()  # the dream records its own stages
+        frametimes.extend([(t - clock) / len(chunk)] * len(chunk))
+        clock = t
+
+        for index, name, img in chunk:
+            print 'Processing: ' + name
+            hallu = dreamed[index]
             np.clip(hallu, 0, 255, out=hallu)
-            PIL.Image.fromarray(np.uint8(hallu)).save(os.path.join(outputdir, 'frame_000000.png'))
-            grayImg = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+            t = profiler.lap('clip', t)
+            getStats(writer.name(index), index + 1, numframe, frametimes)
+            saved = None
+            if manifest is not None and index == chunk[-1][0]:
+                saved = functools.partial(saveManifest, manifest, index, getRandomState())
+            writer.write(index, hallu, saved)
+            t = profiler.lap('write', t)
+            written += 1
+        profiler.frame(chunk[0][0], len(chunk))
+    writer.close()
+    return written
+
+
+# Resuming
+# the manifest in the output directory records the settings of a run and how far it got
+
+def paramsHash(params):
+    return hashlib.sha1(json.dumps(params, sort_keys=True)).hexdigest()
+
+
+def getRandomState():
+    # jitter RNG state, as json
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return [name, keys.tolist(), pos, has_gauss, cached_gaussian]
+
+
+def setRandomState(state):
+    name, keys, pos, has_gauss, cached_gaussian = state
+    np.random.set_state((str(name), np.array(keys, np.uint32), pos, has_gauss, cached_gaussian))
+
+
+def writeManifest(manifest):
+    # write to a temporary file first, so a crash never leaves a broken manifest
+    filename = manifest['path']
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(filename + '.tmp', filename)
+
+
+def stateFile(manifest, last):
+    # two files taken in turn, so the one the manifest points to is never being written
+    return os.path.splitext(manifest['path'])[0] + '.state%d.npy' % (last % 2)
+
+
+def saveManifest(manifest, last, rng, state=None):
+    # record frame last as saved, with the jitter RNG state after it. state is the dream carried
+    # to the next frame, unrounded, so a resumed chain continues exactly like an uninterrupted one
+    if state is not None:
+        saveCached(stateFile(manifest, last), state)
+    manifest['state'] = state is not None
+    manifest['last'] = last
+    manifest['rng'] = rng
+    writeManifest(manifest)
+
+
+def loadState(manifest, writer):
+    # the dream of the last saved frame, as carried by the interrupted run when it was stored
+    if manifest.get('state') and os.path.exists(stateFile(manifest, manifest['last'])):
+        return np.load(stateFile(manifest, manifest['last']))
+    return loadFrame(writer.name(manifest['last']))
+
+
+def startManifest(outputdir, params, vids, resume):
+    filename = os.path.join(outputdir, 'manifest.json')
+    if resume is 1:
+        if not os.path.exists(filename):
+            sys.exit('Cannot resume: no manifest in ' + outputdir)
+        manifest = json.load(open(filename))
+        if manifest['hash'] != paramsHash(params):
+            sys.exit('Cannot resume: settings differ from the interrupted run ' + json.dumps(manifest['params']))
+        if manifest['frames'] != vids:
+            sys.exit('Cannot resume: input frames differ from the interrupted run')
+        manifest['path'] = filename
+        return manifest
+
+    manifest = {'path': filename, 'params': params, 'hash': paramsHash(params), 'layers': params['layers'],
+                'frames': vids, 'last': -1, 'rng': getRandomState()}
+    writeManifest(manifest)
+    return manifest
+
+
+def missingFrames(outputdir, numframe):
+    writer = PngWriter(outputdir)
+    return [index for index in xrange(numframe) if not os.path.exists(writer.name(index))]
+
+
+SCALING_HEADER = 'workers,frames,seconds,fps,settings\n'
+
+
+def reportThroughput(count, elapsed, workers=1, outputdir=None, params=None):
+    fps = count / max(elapsed, 1e-6)
+    print 'Finished processing all frames'
+    print 'Dreamed %d frames in %.1fs (%.2f frames/s)' % (count, elapsed, fps)
+    if outputdir is None or params is None:
+        return
+
+    # keep one line per run, so runs with different --workers can be compared. only runs with the same
+    # settings (params, hashed) are compared. runs that dreamed nothing (a resumed finished run) say nothing about speed
+    report = os.path.join(outputdir, 'scaling.csv')
+    settings = paramsHash(params)[:12]
+    if count > 0:
+        if not os.path.exists(report) or open(report).readline() != SCALING_HEADER:
+            open(report, 'w').write(SCALING_HEADER)  # rows of older versions have no settings to compare on
+        open(report, 'a').write('%d,%d,%.3f,%.4f,%s\n' % (workers, count, elapsed, fps, settings))
+    if not os.path.exists(report) or open(report).readline() != SCALING_HEADER:
+        return
+
+    runs = [line.strip().split(',') for line in open(report).readlines()[1:] if line.strip()]
+    runs = [run for run in runs if float(run[3]) > 0 and run[4] == settings]
+    single = [float(run[3]) for run in runs if run[0] == '1']
+    print 'Scaling report (' + report + ', runs with settings ' + settings + '):'
+    print '  workers  frames/s  speedup  efficiency'
+    for run in runs:
+        if single:
+            speedup = float(run[3]) / single[-1]
+            print '  %7s  %8.2f  %7.2f  %9.0f%%' % (run[0], float(run[3]), speedup, 100 * speedup / int(run[0]))
+        else:
+            print '  %7s  %8.2f        -           -' % (run[0], float(run[3]))
 
-            for v in range(numframe):
-                if var_counter < numframe:
-                    previousImg = img
-                    previousGrayImg = grayImg
 
-                    newframe = os.path.join(inputdir, vids[v + 1])
-                    print 'Processing: ' + newframe
-                    endparam = layers[var_counter % len(layers)]
-
-                    img = np.float32(PIL.Image.open(newframe))
-                    grayImg = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
-                    flow = cv2.calcOpticalFlowFarneback(previousGrayImg, grayImg, pyr_scale=0.5, levels=3, winsize=15,
-                                                        iterations=3, poly_n=5, poly_sigma=1.2, flags=0)
-                    flow = -flow
-                    flow[:, :, 0] += np.arange(w)
-                    flow[:, :, 1] += np.arange(h)[:, np.newaxis]
-                    halludiff = hallu - previousImg
-                    halludiff = cv2.remap(halludiff, flow, None, cv2.INTER_LINEAR)
-                    hallu = img + halludiff
-
-                    now = time.time()
-                    hallu = getFrame(net, hallu, endparam)
-                    later = time.time()
-                    difference = int(later - now)
-                    saveframe = os.path.join(outputdir, 'frame_%06d.png' % (var_counter))
-                    getStats(saveframe, var_counter, numframe, difference)
-
-                    np.clip(hallu, 0, 255, out=hallu)
-                    PIL.Image.fromarray(np.uint8(hallu)).save(saveframe)
-                    var_counter += 1
-                else:
-                    print 'Finished processing all frames'
-    else:
-        # process anim frames
-        for v in range(numframe):
-            if var_counter < numframe:
-                vid = vids[v]
-                h, w = frame.shape[:2]
-                s = 0.05  # scale coefficient  
+# Multi-process dreaming
+# each worker process loads the net once and dreams contiguous chunks of frames
 
-                print 'Processing: ' + os.path.join(inputdir, vid)
+worker = {}
 
-                # setup
-                now = time.time()
-                endparam = layers[var_counter % len(layers)]
-                frame = getFrame(net, frame, endparam)
-                later = time.time()
-                difference = int(later - now)
-                saveframe = os.path.join(outputdir, 'frame_%06d.png' % (var_counter))
-                getStats(saveframe, var_counter, numframe, difference)
-
-                # save image
-                PIL.Image.fromarray(np.uint8(frame)).save(saveframe)
-
-                # setup next image
-                newframe = os.path.join(inputdir, vids[v + 1])
-
-                # blend
-                if blend == 0:
-                    newimg = PIL.Image.open(newframe)
-                    if preview is not 0:
-                        newimg = resizePicture(newframe, preview)
-                    frame = newimg
-                else:
-                    frame = morphPicture(saveframe, newframe, blend, preview)
 
-                # setup next frame
-                frame = np.float32(frame)
-                var_counter += 1
+def initWorker(backend, modeldir, gpu, threads, guides, guidecache, layers, dreamparams):
+    worker['net'] = loadNet(backend, modeldir, gpu, threads)
+    guide_features = None
+    if guides is not None:
+        guide_features = loadGuides(worker['net'], guides, layers, guidecache, [backend, modeldir])
+    worker['getFrame'] = makeGetFrame(guide_features=guide_features, **dreamparams)
+
+
+def dreamChunk(task):
+    # number of frames written, and the profile records of the chunk to merge into the parent's
+    inputdir, outputdir, vids, start, stop, warmup, preview, layers, blend, batch, compression, prefetch, lean = task
+    np.random.seed(start)  # same jitter for a chunk whatever worker picks it up
+    frames = readDirectory(inputdir, vids, preview, max(start - warmup, 0), stop)
+    writer = PngWriter(outputdir, compression)
+    if prefetch:
+        writer = AsyncWriter(writer, prefetch)
+    profiler.frames = []
+    if batch > 1 and blend == 0:
+        count = dreamBatches(worker['net'], frames, writer, worker['getFrame'], len(vids), layers, batch)
+    else:
+        count = dreamFrames(worker['net'], frames, writer, worker['getFrame'], len(vids), layers, blend, 0,
+                            first=start, prefetch=prefetch, lean=lean)
+    return count, profiler.frames, profiler.stages
+
+
+def dreamParallel(backend, modeldir, gpu, threads, guides, guidecache, dreamparams, inputdir, outputdir, vids, preview, layers, blend,
+                  workers, overlap, todo=None, batch=1, compression=None, prefetch=None):
+    # todo: indices of the frames still to render, all by default
+    numframe = len(vids)
+    todo = set(xrange(numframe) if todo is None else todo)
+    if blend == 0:
+        # frames are independent, hand them out one batch at a time
+        size, warmup = batch, 0
+    else:
+        # each chunk first dreams the overlap frames before it, so that its
+        # blend chain starts from a dreamed frame like in a serial run
+        size, warmup = int(math.ceil(len(todo) / float(workers))) if todo else 1, overlap
+    tasks = []
+    for start in xrange(0, numframe, size):
+        stop = min(start + size, numframe)
+        pending = [index for index in xrange(start, stop) if index in todo]
+        if pending:
+            # a chunk that was partly rendered restarts at its first missing frame
+            tasks.append((inputdir, outputdir, vids, pending[0], stop, warmup, preview, layers, blend, batch,
+                          compression, prefetch, dreamparams.get('lean', False)))
+
+    pool = multiprocessing.Pool(workers, initWorker, (backend, modeldir, gpu, threads, guides, guidecache, layers,
+                                                      dreamparams))
+    count = 0
+    try:
+        for written, frames, stages in pool.imap_unordered(dreamChunk, tasks):
+            count += written
+            profiler.frames.extend(frames)
+            profiler.stages.extend(stage for stage in stages if stage not in profiler.stages)
+    finally:
+        pool.close()
+        pool.join()
+    return count
+
+
+# Stereo modes of --binocular. the left eye is dreamed from its own previous dream, the right eye from
+#   serial: its previous dream and the left dream of the same frame, dreamed after the left eye
+#   batch: its previous dream and the left eye's seed, both eyes dreamed as one batch
+#   reproject: the left dream seen from the right, touched up with a few iterations only
+STEREO_MODES = ['serial', 'batch', 'reproject']
+
+
+def stereoConsistency(halluLeft, imgLeft, halluRight, imgRight, flowmap):
+    # mean difference, 0-255, between the right dream and the left dream reprojected onto the right frame.
+    # low when both eyes show the same details at matching points, so the dream has the scene's depth
+    return np.abs(warpDream(halluLeft, imgLeft, imgRight, flowmap) - halluRight).mean()
+
+
+def logStereo(stereolog, index, consistency):
+    print 'Stereo consistency: %.2f' % consistency
+    open(stereolog, 'a').write('%d,%.4f\n' % (index, consistency))
+
+
+def dreamBinocular(net, inputdir, outputdir, vids, getFrame, layers, flowcache=None, stereo='serial', refine=2,
+                   compression=None, prefetch=None):
+    # the three flow fields of a frame (left and right from their previous frame, left to right)
+    # are computed at once. with prefetch, the next pair is read and frames saved on background threads
+    numframe = len(vids[0])
+    writers = []
+    for eye in ('Left', 'Right'):
+        make_sure_path_exists(os.path.join(outputdir, eye))
+        writers.append(PngWriter(os.path.join(outputdir, eye), compression))
+    if prefetch:
+        writers = [AsyncWriter(writer, prefetch) for writer in writers]
+    pool = ThreadPool(3)
+    stereolog = os.path.join(outputdir, 'stereo.csv')
+    open(stereolog, 'w').write('frame,consistency\n')  # binocular runs start over, and so does their log
+
+    def loadPair(index):
+        return [loadFrame(os.path.join(inputdir, eye, vids[n][index])) for n, eye in enumerate(('Left', 'Right'))]
+
+    consistencies = []
+    frametimes = collections.deque(maxlen=ETA_FRAMES)
+    profiler.start()
+    pair = pool.apply_async(loadPair, (0,)) if prefetch else None
+    clock = t = time.time()
+    for index in xrange(numframe):
+        if prefetch:
+            imgLeft, imgRight = pair.get()
+            if index + 1 < numframe:
+                pair = pool.apply_async(loadPair, (index + 1,))
+        else:
+            imgLeft, imgRight = loadPair(index)
+        t = profiler.lap('read', t)
+        print 'Processing: ' + os.path.join(inputdir, 'Left', vids[0][index])
+        print 'Processing: ' + os.path.join(inputdir, 'Right', vids[1][index])
+        endparam = layers[index % len(layers)]
+
+        grayImgLeft, grayImgRight = grayFrame(imgLeft), grayFrame(imgRight)
+        t = profiler.lap('gray', t)
+        flows = {'stereo': pool.apply_async(opticalFlow, (grayImgLeft, grayImgRight, flowcache))}
+        if index > 0:
+            flows['left'] = pool.apply_async(opticalFlow, (previousGrayImgLeft, grayImgLeft, flowcache))
+            if stereo != 'reproject':
+                flows['right'] = pool.apply_async(opticalFlow, (previousGrayImgRight, grayImgRight, flowcache))
+        flows = dict((key, flowmap.get()) for key, flowmap in flows.items())
+        t = profiler.lap('flow', t)
+
+        frameLeft = imgLeft if index == 0 else warpDream(halluLeft, previousImgLeft, imgLeft, flows['left'])
+        if stereo == 'batch' and index > 0:
+            # the right eye cannot wait for the left dream, it takes the seed of the left eye instead
+            halludiffRight = warpDream(halluRight, previousImgRight, 0, flows['right'])
+            halludiffLeft = warpDream(frameLeft, imgLeft, 0, flows['stereo'])
+            frameRight = imgRight + halludiffRight / 2 + halludiffLeft / 2
+            profiler.lap('warp', t)
+            halluLeft, halluRight = getFrame(net, [frameLeft, frameRight], endparam)
+        else:
+            profiler.lap('warp', t)
+            halluLeft = getFrame(net, frameLeft, endparam)
+            t = time.time()
+            if stereo == 'serial' and index > 0:
+                halludiffRight = warpDream(halluRight, previousImgRight, 0, flows['right'])
+                halludiffLeft = warpDream(halluLeft, imgLeft, 0, flows['stereo'])
+                frameRight = imgRight + halludiffRight / 2 + halludiffLeft / 2
             else:
-                print 'Finished processing all frames'
+                # the first right frame starts from the left dream, and so does every one with reproject
+                frameRight = warpDream(halluLeft, imgLeft, imgRight, flows['stereo'])
+            profiler.lap('warp', t)
+            halluRight = getFrame(net, frameRight, endparam, None if stereo == 'serial' else refine)
+        t = time.time()  # the dream records its own stages
+        np.clip(halluLeft, 0, 255, out=halluLeft)
+        np.clip(halluRight, 0, 255, out=halluRight)
+        t = profiler.lap('clip', t)
+        consistencies.append(stereoConsistency(halluLeft, imgLeft, halluRight, imgRight, flows['stereo']))
+        logStereo(stereolog, index, consistencies[-1])
+        t = profiler.lap('consistency', t)
+
+        # a frame is the left and right image
+        frametimes.append(t - clock)
+        clock = t
+        getStats(writers[1].name(index), index + 1, numframe, frametimes)
+        writers[0].write(index, halluLeft)
+        writers[1].write(index, halluRight)
+        t = profiler.lap('write', t)
+        profiler.frame(index)
+
+        previousImgLeft, previousGrayImgLeft = imgLeft, grayImgLeft
+        previousImgRight, previousGrayImgRight = imgRight, grayImgRight
+    for writer in writers:
+        writer.close()
+    pool.close()
+    print 'Mean stereo consistency: %.2f (%s)' % (sum(consistencies) / max(len(consistencies), 1), stereolog)
+    return numframe
+
+
+# Keyframe dreaming
+# only keyframes are dreamed, the frames between two keyframes get their dream details (dream minus
+# input) carried forward from the keyframe before and backward from the keyframe after, frame by frame along the flow
+
+KEYFRAME_OCCLUSION = 10.0  # accumulated warp error (0-255) at which a carried detail has lost 63% of its weight
+
+
+def chooseKeyframes(inputdir, vids, preview, spacing, motion=None, flowcache=None):
+    # indices of the keyframes: the first and last frame and every spacing-th frame. with motion, a keyframe
+    # also starts once the frames since the last one moved more than motion pixels, or at a cut
+    keyframes = [0]
+    moved = 0.0
+    previousImg = loadFrame(os.path.join(inputdir, vids[0]), preview)
+    for index in xrange(1, len(vids)):
+        cut = False
+        if motion is not None:
+            img = loadFrame(os.path.join(inputdir, vids[index]), preview)
+            change, residual = frameChange(previousImg, img,
+                                           opticalFlow(grayFrame(previousImg), grayFrame(img), flowcache))
+            moved += change
+            cut = moved > motion or residual > ADAPTIVE_RESIDUAL
+            previousImg = img
+        if cut or index - keyframes[-1] >= spacing or index == len(vids) - 1:
+            keyframes.append(index)
+            moved = 0.0
+    return keyframes
+
+
+def carryDetails(imgs, grays, detail, flowcache):
+    # detail of imgs[0] carried onto every frame of imgs along the flow, and the warp error accumulated on the way
+    import cv2
+    details = [detail]
+    errors = [np.zeros(imgs[0].shape[:2], np.float32)]
+    for previousImg, previousGrayImg, img, grayImg in zip(imgs, grays, imgs[1:], grays[1:]):
+        flowmap = opticalFlow(previousGrayImg, grayImg, flowcache)
+        details.append(cv2.remap(details[-1], flowmap, None, cv2.INTER_LINEAR))
+        error = np.abs(cv2.remap(previousImg, flowmap, None, cv2.INTER_LINEAR) - img).mean(axis=2)
+        errors.append(cv2.remap(errors[-1], flowmap, None, cv2.INTER_LINEAR) + error)
+    return details, errors
+
+
+def interpolateSegment(task):
+    # synthesize the frames between keyframes start and stop, already dreamed in outputdir.
+    # with refine, they get that many iterations of the net of the worker. returns the number of frames written
+    inputdir, outputdir, vids, preview, start, stop, layers, flowcache, refine, compression = task
+    writer = PngWriter(outputdir, compression)
+    imgs = [loadFrame(os.path.join(inputdir, vids[index]), preview) for index in xrange(start, stop + 1)]
+    grays = [grayFrame(img) for img in imgs]
+    forward, forwardErrors = carryDetails(imgs, grays, loadFrame(writer.name(start)) - imgs[0], flowcache)
+    backward, backwardErrors = carryDetails(imgs[::-1], grays[::-1], loadFrame(writer.name(stop)) - imgs[-1],
+                                            flowcache)
+    backward, backwardErrors = backward[::-1], backwardErrors[::-1]
+
+    for k in xrange(1, stop - start):
+        # the nearer keyframe counts more, and a detail counts less the more the warp failed on its way (occlusions)
+        position = float(k) / (stop - start)
+        forwardWeight = (1 - position) * np.exp(-forwardErrors[k] / KEYFRAME_OCCLUSION)[:, :, np.newaxis]
+        backwardWeight = position * np.exp(-backwardErrors[k] / KEYFRAME_OCCLUSION)[:, :, np.newaxis]
+        detail = (forwardWeight * forward[k] + backwardWeight * backward[k]) / (forwardWeight + backwardWeight + 1e-6)
+        hallu = imgs[k] + detail
+        if refine:
+            hallu = worker['getFrame'](worker['net'], hallu, layers[(start + k) % len(layers)], refine)
+        np.clip(hallu, 0, 255, out=hallu)
+        writer.write(start + k, hallu)
+    return stop - start - 1
+
+
+def interpolateKeyframes(inputdir, outputdir, vids, preview, layers, keyframes, flowcache, refine, pool=None,
+                         compression=None):
+    # fill in the frames between all keyframes, one segment per task, on the worker pool when given.
+    # with refine, its workers must have loaded the net (initWorker), else the net of this process is used
+    tasks = [(inputdir, outputdir, vids, preview, start, stop, layers, flowcache, refine, compression)
+             for start, stop in zip(keyframes, keyframes[1:]) if stop - start > 1]
+    count = 0
+    if pool is not None:
+        for written in pool.imap_unordered(interpolateSegment, tasks):
+            count += written
+            print 'Interpolated %d of %d frames' % (count, len(vids) - len(keyframes))
+    else:
+        for task in tasks:
+            count += interpolateSegment(task)
+            print 'Interpolated %d of %d frames' % (count, len(vids) - len(keyframes))
+    return count
+
+
+# Guided dreaming
+# every position of the dreamed layer is pulled towards the guide feature it matches best
+
+GUIDE_CHUNK = 4096  # positions matched per matrix product, bounds the dot-product matrix to GUIDE_CHUNK x guide positions
+
+
+def loadGuide(net, filename, end, guidecache=None, model=None):
+    # features of the guide image at layer end. with guidecache, they are stored there,
+    # keyed on the guide image contents, the layer and the model
+    if guidecache is not None:
+        key = hashlib.sha1(open(filename, 'rb').read())
+        key.update(json.dumps([end, model]))
+        cached = os.path.join(guidecache, key.hexdigest() + '.npy')
+        if os.path.exists(cached):
+            return np.load(cached)
+
+    guideimg = PIL.Image.open(filename)
+    guideimgresized = guideimg.resize((224, 224), PIL.Image.ANTIALIAS)
+    guide = np.float32(guideimgresized)
+    h, w = guide.shape[:2]
+    net.reshape(1, h, w)
+    net.input.data[0] = preprocess(net, guide)
+    features = net.forward(end).data[0].copy()
+
+    if guidecache is not None:
+        make_sure_path_exists(guidecache)
+        saveCached(cached, features)
+    return features
+
+
+def loadGuides(net, guides, layers, guidecache=None, model=None):
+    # guide features of every layer of the cycle, by layer name. guides go with the layers in order,
+    # a single guide is used for all of them. a layer listed twice keeps the guide of its first place
+    guide_features = {}
+    for index, end in enumerate(layers):
+        if end not in guide_features:
+            guide_features[end] = loadGuide(net, guides[index % len(guides)], end, guidecache, model)
+    return guide_features
+
+
+def matchGuide(x, y, chunk=GUIDE_CHUNK, out=None):
+    # index of the column of y with the largest dot product, for every column of x
+    n = x.shape[1]
+    if out is None:
+        out = np.empty(n, np.intp)
+    for start in xrange(0, n, chunk):
+        np.dot(x[:, start:start + chunk].T, y).argmax(1, out=out[start:start + chunk])
+    return out
+
+
+def guideObjective(guide_features, channels=None, chunk=GUIDE_CHUNK):
+    # objective pulling every position towards its best match among the guide features.
+    # with channels, matches are searched on that many principal components of the guide
+    # features instead of all channels: faster at deep layers, and approximate
+    ch = guide_features.shape[0]
+    y = np.ascontiguousarray(guide_features.reshape(ch, -1))
+    projection, match = None, y
+    if channels and channels < ch:
+        projection = np.float32(np.linalg.svd(y, full_matrices=False)[0][:, :channels].T)
+        match = projection.dot(y)
+
+    def objective_guide(dst):
+        for n in xrange(len(dst.data)):
+            x = dst.data[n].reshape(ch, -1)
+            if projection is not None:
+                x = projection.dot(x)
+            best = matchGuide(x, match, chunk)
+            np.take(y, best, axis=1, out=dst.diff[n].reshape(ch, -1), mode='clip')  # select ones that match best
+
+    return objective_guide
+
+
+def objective_guide_dense(dst, guide_features):
+    # the original guided objective, with the full dot-product matrix. for benchmarkGuide
+    y = guide_features
+    ch = y.shape[0]
+    y = y.reshape(ch, -1)
+    for n in xrange(len(dst.data)):
+        x = dst.data[n].reshape(ch, -1)
+        A = x.T.dot(y)  # compute the matrix of dot-products with guide features
+        dst.diff[n].reshape(ch, -1)[:] = y[:, A.argmax(1)]  # select ones that match best
+
+
+def benchmarkGuide(net, frame, guide_features, octave_n, octave_scale, channels=(None, 64, 32), steps=3):
+    # ms per call of the guided objective at every octave size, dense against chunked, and with
+    # principal components the share of positions that still find the exact match
+    print 'layer                    octave      size  channels     ms  speedup  exact'
+    for end, features in sorted(guide_features.items()):
+        for octave, (h, w) in enumerate(octaveShapes(frame.shape[0], frame.shape[1], octave_n, octave_scale)[::-1]):
+            net.reshape(1, h, w)
+            net.input.data[0] = preprocess(net, nd.zoom(frame, (1.0 * h / frame.shape[0], 1.0 * w / frame.shape[1], 1),
+                                                       order=1))
+            dst = net.forward(end)
+            now = time.time()
+            for i in xrange(steps):
+                objective_guide_dense(dst, features)
+            dense = (time.time() - now) / steps
+            exact = dst.diff.copy()
+            print '%-24s %6d %9s %9s %6.1f %7.2fx %5.0f%%' % (end, octave, '%dx%d' % (w, h), 'dense', 1e3 * dense, 1, 100)
+            for size in channels:
+                if size is not None and size >= features.shape[0]:
+                    continue
+                objective = guideObjective(features, size)
+                now = time.time()
+                for i in xrange(steps):
+                    objective(dst)
+                seconds = (time.time() - now) / steps
+                same = (dst.diff == exact).all(axis=1).mean()
+                print '%-24s %6d %9s %9s %6.1f %7.2fx %5.0f%%' % (end, octave, '%dx%d' % (w, h), size or 'chunked',
+                                                                1e3 * seconds, dense / max(seconds, 1e-9), 100 * same)
+
+
+def makeGetFrame(iterations, stepsize, octaves, octave_scale, jitter, tile=None, debug=0, guide_features=None,
+                 guidechannels=None, draft=None, draftiterations=0, lean=False):
+    # guide_features: features of the guide of every layer, by layer name
+    objectives = dict((end, guideObjective(features, guidechannels))
+                      for end, features in (guide_features or {}).items())
+
+    def getFrame(net, frame, endparam, iter_n=None):
+        # dream frame, or a list of same-size frames as one batch. iter_n overrides the iterations
+        if iter_n is None:
+            iter_n = iterations
+        if isinstance(frame, list):
+            dream = functools.partial(deepdream_batch, debug=debug, draft=draft, draft_iter=draftiterations)
+        else:
+            dream = functools.partial(deepdream, tile=tile, debug=debug, draft=draft, draft_iter=draftiterations,
+                                      lean=lean)
+        if endparam not in objectives:
+            return dream(net, frame, iter_n=iter_n, step_size=stepsize, octave_n=octaves,
+                         octave_scale=octave_scale, jitter=jitter, end=endparam)
+        else:
+            return dream(net, frame, iter_n=iter_n, step_size=stepsize, octave_n=octaves,
+                         octave_scale=octave_scale, jitter=jitter, end=endparam, objective=objectives[endparam])
+
+    return getFrame
+
+
+# Distributed rendering
+# a job directory on a shared filesystem holds a SQLite queue of segments. workers on any machine
+# claim a segment under a lease, dream it into a staging directory of their own, and the stitch step
+# validates the segments and assembles them into the frame sequence or the final video
+
+QUEUE_LEASE = 600  # seconds a claim lasts without a heartbeat, before another worker may take the segment over
+QUEUE_RETRIES = 3  # claims of a segment before it is marked failed
+
+
+class JobQueue(object):
+    # lease is how long the claims of this worker last without being renewed
+    def __init__(self, jobdir, lease=QUEUE_LEASE):
+        import sqlite3
+        self.jobdir = jobdir
+        self.lease = lease
+        self.db = sqlite3.connect(os.path.join(jobdir, 'queue.sqlite'), timeout=60, isolation_level=None)
+
+    def create(self, settings, vids, size, overlap):
+        # one segment per size frames. each is dreamed after overlap warm-up frames, so its blend or flow chain
+        # starts from a dreamed frame
+        self.db.execute('CREATE TABLE job (settings TEXT, frames TEXT)')
+        self.db.execute('CREATE TABLE segments (id INTEGER PRIMARY KEY, start INTEGER, stop INTEGER, warmup INTEGER, '
+                        'state TEXT, worker TEXT, lease REAL, attempts INTEGER, path TEXT, error TEXT)')
+        self.db.execute('INSERT INTO job VALUES (?, ?)', (json.dumps(settings), json.dumps(vids)))
+        for start in xrange(0, len(vids), size):
+            self.db.execute('INSERT INTO segments (start, stop, warmup, state, attempts) VALUES (?, ?, ?, ?, 0)',
+                            (start, min(start + size, len(vids)), overlap, 'todo'))
+
+    def job(self):
+        settings, vids = self.db.execute('SELECT settings, frames FROM job').fetchone()
+        return json.loads(settings), json.loads(vids)
+
+    def claim(self, worker):
+        # the next segment to do, or one whose lease ran out: (id, start, stop, warmup), None when there is none
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            self.db.execute("UPDATE segments SET state = 'failed' WHERE state = 'running' AND lease < ? AND attempts >= ?",
+                            (time.time(), QUEUE_RETRIES))
+            row = self.db.execute("SELECT id, start, stop, warmup FROM segments WHERE state = 'todo' OR "
+                                  "(state = 'running' AND lease < ?) ORDER BY id LIMIT 1", (time.time(),)).fetchone()
+            if row is not None:
+                self.db.execute("UPDATE segments SET state = 'running', worker = ?, lease = ?, attempts = attempts + 1 "
+                                "WHERE id = ?", (worker, time.time() + self.lease, row[0]))
+            self.db.execute('COMMIT')
+        except Exception:
+            self.db.execute('ROLLBACK')
+            raise
+        return row
+
+    def renew(self, segment, worker):
+        # extend the lease, false when the segment was taken over by another worker
+        return self.db.execute("UPDATE segments SET lease = ? WHERE id = ? AND worker = ? AND state = 'running'",
+                               (time.time() + self.lease, segment, worker)).rowcount == 1
+
+    def finish(self, segment, worker, path):
+        return self.db.execute("UPDATE segments SET state = 'done', path = ?, error = NULL "
+                               "WHERE id = ? AND worker = ? AND state = 'running'", (path, segment, worker)).rowcount == 1
+
+    def fail(self, segment, worker, error):
+        # give the segment back, or mark it failed after QUEUE_RETRIES claims
+        self.db.execute("UPDATE segments SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'todo' END, error = ? "
+                        "WHERE id = ? AND worker = ? AND state = 'running'", (QUEUE_RETRIES, error, segment, worker))
+
+    def retry(self):
+        # put failed segments back in the queue, with all their claims
+        return self.db.execute("UPDATE segments SET state = 'todo', attempts = 0 WHERE state = 'failed'").rowcount
+
+    def segments(self):
+        return self.db.execute('SELECT id, start, stop, state, worker, attempts, path, error FROM segments '
+                               'ORDER BY id').fetchall()
+
+
+class Heartbeat(object):
+    # renew the lease of a segment every quarter lease while it is dreamed, warm-up frames and slow frames included.
+    # runs on a thread with a connection of its own, sqlite connections cannot be shared between threads
+    def __init__(self, jobdir, segment, worker, lease):
+        self.jobdir, self.segment, self.worker, self.lease = jobdir, segment, worker, lease
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        queue = JobQueue(self.jobdir, self.lease)
+        while not self.stopped.wait(self.lease / 4.0):
+            if not queue.renew(self.segment, self.worker):
+                self.lost = True
+                break
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+
+class LeaseWriter(PngWriter):
+    # PngWriter that stops the segment when another worker has taken it over
+    def __init__(self, outputdir, heartbeat, compression=None):
+        PngWriter.__init__(self, outputdir, compression)
+        self.heartbeat = heartbeat
+
+    def write(self, index, frame, done=None):
+        if self.heartbeat.lost:
+            raise RuntimeError('Lost the lease of segment %d' % self.heartbeat.segment)
+        PngWriter.write(self, index, frame, done)
+
+
+def validFrames(writer, start, stop):
+    # true when frames start to stop of writer are all there and decode
+    for index in xrange(start, stop):
+        try:
+            PIL.Image.open(writer.name(index)).verify()
+        except Exception:
+            return False
+    return True
+
+
+def submitJob(jobdir, inputdir, settings, size, overlap):
+    make_sure_path_exists(jobdir)
+    if os.path.exists(os.path.join(jobdir, 'queue.sqlite')):
+        sys.exit('A job was already submitted to ' + jobdir)
+    vids = listFrames(inputdir)
+    JobQueue(jobdir).create(settings, vids, size, overlap)
+    print 'Submitted %d frames in %d segments to %s' % (len(vids), int(math.ceil(len(vids) / float(size))), jobdir)
+
+
+def workQueue(jobdir, inputdir, gpu, threads, flowcache, guidecache, compression, lease=QUEUE_LEASE):
+    # dream segments of the job until none is left. inputdir is where this machine sees the job's frames
+    queue = JobQueue(jobdir, lease)
+    settings, vids = queue.job()
+    if listFrames(inputdir) != vids:
+        sys.exit('Input frames in ' + inputdir + ' differ from the job')
+    name = '%s-%d' % (os.uname()[1], os.getpid())
+    net = loadNet(settings['backend'], settings['model'], gpu, threads)
+    guide_features = None
+    if settings['guide'] is not None:
+        guide_features = loadGuides(net, [os.path.join(inputdir, image) for image in settings['guide']],
+                                    settings['layers'], guidecache, [settings['backend'], settings['model']])
+    getFrame = makeGetFrame(guide_features=guide_features, **settings['dreamparams'])
+    count = 0
+    while True:
+        segment = queue.claim(name)
+        if segment is None:
+            break
+        segment, start, stop, warmup = segment
+        print 'Worker %s dreaming segment %d (frames %d to %d)' % (name, segment, start, stop - 1)
+        stagedir = os.path.join(jobdir, 'segments', '%05d-%s' % (segment, name))
+        make_sure_path_exists(stagedir)
+        heartbeat = Heartbeat(jobdir, segment, name, lease)
+        writer = LeaseWriter(stagedir, heartbeat, compression)
+        try:
+            np.random.seed(start)  # same jitter for a segment whatever worker dreams it
+            frames = readDirectory(inputdir, vids, settings['preview'], max(start - warmup, 0), stop)
+            dreamFrames(net, frames, writer, getFrame, len(vids), settings['layers'], settings['blend'],
+                        settings['flow'], first=start, flowcache=flowcache,
+                        lean=settings['dreamparams'].get('lean', False))
+            if not validFrames(writer, start, stop):
+                raise RuntimeError('Segment %d has missing or broken frames' % segment)
+        except Exception as error:
+            print 'Segment %d failed: %s' % (segment, error)
+            queue.fail(segment, name, str(error))
+            continue
+        finally:
+            heartbeat.stop()
+        if queue.finish(segment, name, os.path.relpath(stagedir, jobdir)):
+            count += stop - start
+    print 'Worker %s done, dreamed %d frames' % (name, count)
+    return count
+
+
+def runWorkers(workers, *args):
+    # several local workers, in processes of their own
+    processes = [multiprocessing.Process(target=workQueue, args=args) for i in xrange(workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+
+def queueStatus(jobdir):
+    segments = JobQueue(jobdir).segments()
+    states = collections.Counter(segment[3] for segment in segments)
+    print 'Job %s: %d segments, %s' % (jobdir, len(segments), ', '.join('%d %s' % (states[state], state)
+                                                                    for state in sorted(states)))
+    for segment, start, stop, state, name, attempts, path, error in segments:
+        if error is not None and state != 'done':
+            print '  segment %d (frames %d to %d), %d attempts: %s' % (segment, start, stop - 1, attempts, error)
+    return segments
+
+
+def stitchJob(jobdir, output, framerate, buffersize):
+    # copy the frames of every segment into the frame sequence output, or encode them into the video output
+    segments = queueStatus(jobdir)
+    if any(state != 'done' for segment, start, stop, state, name, attempts, path, error in segments):
+        sys.exit('Cannot stitch: not every segment is done')
+    writers = [(start, stop, PngWriter(os.path.join(jobdir, path)))
+               for segment, start, stop, state, name, attempts, path, error in segments]
+    for start, stop, writer in writers:
+        if not validFrames(writer, start, stop):
+            sys.exit('Cannot stitch: frames %d to %d in %s are missing or broken' % (start, stop - 1, writer.outputdir))
+
+    if os.path.splitext(output)[1]:
+        width, height = PIL.Image.open(writers[0][2].name(0)).size
+        width, height = width - width % 2, height - height % 2  # x264 needs even sizes
+        if os.path.dirname(output):
+            make_sure_path_exists(os.path.dirname(output))
+        target = VideoWriter(output, width, height, framerate or 25, buffersize)
+    else:
+        make_sure_path_exists(output)
+        target = PngWriter(output)
+    for start, stop, writer in writers:
+        for index in xrange(start, stop):
+            if isinstance(target, PngWriter):
+                shutil.copyfile(writer.name(index), target.name(index))
+            else:
+                target.write(index, np.asarray(PIL.Image.open(writer.name(index)).convert('RGB'))[:height, :width])
+    target.close()
+    print 'Stitched %d frames into %s' % (writers[-1][1], output)
+
+
+# Parameter sweeps
+# many dream settings run on the same frames: the net is loaded once per worker, the frames
+# are read and resized once, and flow fields are computed once into the flow cache
+
+SWEEP_KEYS = ['layers', 'octaves', 'octavescale', 'iterations', 'stepsize', 'jitter', 'blend']
+SHEET_FRAMES = 4  # frames of every config shown in the contact sheet
+SHEET_WIDTH = 240  # width of a contact sheet thumbnail
+
+
+def sweepConfigs(spec):
+    # settings of every config of a sweep file. 'configs' lists them one by one, 'grid' lists
+    # the values of each setting and runs every combination. settings not given keep their command line value
+    configs = [dict(config) for config in spec.get('configs', [])]
+    grid = spec.get('grid', {})
+    if grid:
+        keys = sorted(grid)
+        configs += [dict(zip(keys, values)) for values in itertools.product(*[grid[key] for key in keys])]
+    for config in configs:
+        unknown = set(config) - set(SWEEP_KEYS)
+        if unknown:
+            sys.exit('Unknown sweep settings: ' + ', '.join(sorted(unknown)) + ', use ' + ', '.join(SWEEP_KEYS))
+        if isinstance(config.get('layers'), basestring):
+            config['layers'] = [config['layers']]
+    return configs
+
+
+def initSweep(backend, modeldir, gpu, threads, guides, guidecache, layers, frames):
+    worker['net'] = loadNet(backend, modeldir, gpu, threads)
+    worker['guide_features'] = None
+    if guides is not None:
+        worker['guide_features'] = loadGuides(worker['net'], guides, layers, guidecache, [backend, modeldir])
+    worker['frames'] = frames
+
+
+def dreamConfig(task):
+    # dream the sweep's frames with the settings of one config, returns its number and seconds
+    number, settings, dreamparams, outputdir, flow, flowcache = task
+    np.random.seed(number)  # same jitter for a config whatever worker picks it up
+    make_sure_path_exists(outputdir)
+    getFrame = makeGetFrame(settings['iterations'], settings['stepsize'], settings['octaves'], settings['octavescale'],
+                            settings['jitter'], guide_features=worker['guide_features'], **dreamparams)
+    now = time.time()
+    dreamFrames(worker['net'], worker['frames'], PngWriter(outputdir), getFrame, len(worker['frames']),
+                settings['layers'], settings['blend'], flow, flowcache=flowcache,
+                lean=dreamparams.get('lean', False))
+    return number, time.time() - now
+
+
+def contactSheet(filename, rows):
+    # rows of (label, frame files) as one image, a label above every row of thumbnails
+    import PIL.ImageDraw
+    thumbs = []
+    for label, files in rows:
+        images = [PIL.Image.open(name) for name in files]
+        thumbs.append((label, [image.resize((SHEET_WIDTH, SHEET_WIDTH * image.size[1] // image.size[0]),
+                                            PIL.Image.ANTIALIAS) for image in images]))
+    height = max(image.size[1] for label, images in thumbs for image in images)
+    columns = max(len(images) for label, images in thumbs)
+    sheet = PIL.Image.new('RGB', (columns * SHEET_WIDTH, len(thumbs) * (height + 16)), (255, 255, 255))
+    draw = PIL.ImageDraw.Draw(sheet)
+    for row, (label, images) in enumerate(thumbs):
+        top = row * (height + 16)
+        draw.text((2, top + 2), label, fill=(0, 0, 0))
+        for column, image in enumerate(images):
+            sheet.paste(image, (column * SHEET_WIDTH, top + 16))
+    sheet.save(filename)
+
+
+def runSweep(sweepfile, backend, modeldir, gpu, threads, guides, guidecache, dreamparams, inputdir, outputdir, preview,
+             base, flow, flowcache, workers):
+    # dream every config of sweepfile into outputdir/config_NNN, with base for the settings a config does not set.
+    # the sweep file can limit the run to its first 'frames' input frames
+    spec = json.load(open(sweepfile))
+    if isinstance(spec, list):
+        spec = {'configs': spec}
+    configs = [dict(base, **config) for config in sweepConfigs(spec)]
+    # guides keep the pairing with the command line layers, layers only some configs use need a single guide
+    layers = list(base['layers'])
+    layers += sorted(set(itertools.chain(*[config['layers'] for config in configs])) - set(layers))
+    if guides is not None and len(guides) > 1 and len(layers) > len(base['layers']):
+        sys.exit('Layers ' + ', '.join(layers[len(base['layers']):]) + ' of the sweep have no guide, '
+                 'give a single --guide or add them to --layers')
+    vids = listFrames(inputdir)[:spec.get('frames')]
+    frames = list(readDirectory(inputdir, vids, preview))
+    print 'Sweep of %d configs on %d frames' % (len(configs), len(frames))
+
+    if flow is 1:
+        # flow fields only depend on the frames, every config reads them from the cache
+        if flowcache is None:
+            flowcache = os.path.join(outputdir, 'flowcache')
+        grays = [grayFrame(img) for index, name, img in frames]
+        pool = ThreadPool(multiprocessing.cpu_count())
+        pool.map(lambda pair: cachedFlow(pair[0], pair[1], flowcache), zip(grays, grays[1:]))
+        pool.close()
+
+    tasks = [(number, config, dreamparams, os.path.join(outputdir, 'config_%03d' % number), flow, flowcache)
+             for number, config in enumerate(configs)]
+    seconds = {}
+    now = time.time()
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, initSweep, (backend, modeldir, gpu, threads, guides, guidecache, layers,
+                                                         frames))
+        try:
+            for number, elapsed in pool.imap_unordered(dreamConfig, tasks):
+                seconds[number] = elapsed
+                print 'Config %d of %d done in %.1fs' % (len(seconds), len(configs), elapsed)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        initSweep(backend, modeldir, gpu, threads, guides, guidecache, layers, frames)
+        for task in tasks:
+            number, elapsed = dreamConfig(task)
+            seconds[number] = elapsed
+            print 'Config %d of %d done in %.1fs' % (len(seconds), len(configs), elapsed)
+    print 'Swept %d configs in %.1fs' % (len(configs), time.time() - now)
+
+    report = os.path.join(outputdir, 'sweep.csv')
+    with open(report, 'w') as f:
+        f.write(','.join(['config'] + SWEEP_KEYS + ['seconds', 'fps']) + '\n')
+        for number, config in enumerate(configs):
+            row = [number] + [' '.join(config[key]) if key == 'layers' else config[key] for key in SWEEP_KEYS]
+            row += ['%.3f' % seconds[number], '%.4f' % (len(frames) / max(seconds[number], 1e-6))]
+            f.write(','.join(map(str, row)) + '\n')
+
+    shown = sorted(set(int(round(i * (len(frames) - 1) / max(SHEET_FRAMES - 1.0, 1))) for i in xrange(SHEET_FRAMES)))
+    rows = []
+    for number, config, dreamparams, configdir, flow, flowcache in tasks:
+        label = '%d: %s  %.1fs' % (number, ' '.join('%s=%s' % (key, ' '.join(config[key]) if key == 'layers' else config[key])
+                                                     for key in SWEEP_KEYS), seconds[number])
+        rows.append((label, [PngWriter(configdir).name(frames[index][0]) for index in shown]))
+    contactSheet(os.path.join(outputdir, 'sweep.png'), rows)
+    print 'Timings in ' + report + ', contact sheet in ' + os.path.join(outputdir, 'sweep.png')
+
+
+def main(inputdir, outputdir, modeldir, preview, octaves, octave_scale, iterations, jitter, zoom, stepsize, blend, layers, guide,
+         gpu, flow, binocular, pipe, framerate, buffersize, workers, overlap, resume, flowcache, batch, benchmark,
+         backend, threads, tile, debug, adaptive, quality, profile, pipeline, pngcompression, stereo, refine,
+         guidecache, guidechannels, sweep, draft, draftiterations, keyframes, keymotion, keyrefine, queue, segment,
+         lean, lease):
+    # input var setup
+    if pipe is None: pipe = 0
+    if pipe is 0:
+        make_sure_path_exists(inputdir)
+        make_sure_path_exists(outputdir)
+    elif os.path.dirname(outputdir):
+        make_sure_path_exists(os.path.dirname(outputdir))
+    if modeldir is None: modeldir = '../../caffe/models/'
+    if preview is None: preview = 0
+    if octaves is None: octaves = 4
+    if octave_scale is None: octave_scale = 1.5
+    if iterations is None: iterations = 10
+    if jitter is None: jitter = 32
+    if zoom is None: zoom = 1
+    if stepsize is None: stepsize = 1.5
+    if blend is None: blend = 0.5
+    if backend is None: backend = 'caffe'
+    if layers is None: layers = [BACKENDS[backend].default_layer]
+    if gpu is None: gpu = 1
+    if flow is None: flow = 0
+    if binocular is None: binocular = 0
+    if buffersize is None: buffersize = 4
+    if workers is None: workers = 1
+    if overlap is None: overlap = 3
+    if resume is None: resume = 0
+    if batch is None: batch = 1
+    if debug is None: debug = 0
+    if adaptive is None: adaptive = 0
+    if quality is None: quality = 0.3
+    if profile is None: profile = 0
+    if pipeline is None: pipeline = 0
+    if stereo is None: stereo = 'serial'
+    if refine is None: refine = 2
+    if draftiterations is None: draftiterations = 0
+    if keyrefine is None: keyrefine = 0
+    if segment is None: segment = 50
+    if lean is None: lean = 0
+    if lease is None: lease = QUEUE_LEASE
+    # net.blobs.keys()
+
+    dreamparams = dict(iterations=iterations, stepsize=stepsize, octaves=octaves, octave_scale=octave_scale,
+                       jitter=jitter, tile=tile, debug=debug, guidechannels=guidechannels, draft=draft,
+                       draftiterations=draftiterations, lean=lean is 1)
+    # guide, one image for all layers or one per layer
+    if guide is not None:
+        guide = [os.path.join(os.path.dirname(inputdir) if pipe is 1 else inputdir, image) for image in guide]
+    # settings that change the dreamed frames, a resumed run must use the same
+    params = dict(dreamparams, backend=backend, model=modeldir, preview=preview, blend=blend, layers=layers,
+                  guide=guide[0] if guide is not None and len(guide) == 1 else guide, flow=flow)
+    del params['debug']
+    if guidechannels is None:
+        del params['guidechannels']
+    if draft is None:
+        del params['draft'], params['draftiterations']
+    if lean is 0:
+        del params['lean']
+    if adaptive is 1:
+        params['quality'] = quality
+    adaptive = (iterations, quality) if adaptive is 1 else None
+    profiler.enabled = profile is 1
+    prefetch = buffersize if pipeline is 1 else None
+
+    if queue == 'submit':
+        submitJob(outputdir, inputdir, dict(dreamparams=dreamparams, layers=layers, blend=blend, flow=flow,
+                                            preview=preview, backend=backend, model=modeldir,
+                                            guide=guide and [os.path.relpath(image, inputdir) for image in guide]),
+                  segment, overlap)
+        return
+    elif queue == 'work':
+        args = (outputdir, inputdir, gpu, threads, flowcache, guidecache, pngcompression, lease)
+        if workers > 1:
+            runWorkers(workers, *args)
+        else:
+            workQueue(*args)
+        return
+    elif queue == 'status':
+        queueStatus(outputdir)
+        return
+    elif queue == 'retry':
+        print 'Queued %d failed segments again' % JobQueue(outputdir).retry()
+        return
+
+    if sweep is not None:
+        runSweep(sweep, backend, modeldir, gpu, threads, guide, guidecache,
+                 dict(tile=tile, debug=debug, guidechannels=guidechannels, draft=draft, draftiterations=draftiterations,
+                      lean=lean is 1),
+                 inputdir, outputdir, preview,
+                 dict(layers=layers, octaves=octaves, octavescale=octave_scale, iterations=iterations,
+                      stepsize=stepsize, jitter=jitter, blend=blend), flow, flowcache, workers)
+        return
+
+    if workers > 1 and keyframes is None:
+        vids = listFrames(inputdir)
+        startManifest(outputdir, params, vids, resume)
+        todo = missingFrames(outputdir, len(vids)) if resume is 1 else None
+        now = time.time()
+        count = dreamParallel(backend, modeldir, gpu, threads, guides=guide, guidecache=guidecache, dreamparams=dreamparams,
+                              inputdir=inputdir, outputdir=outputdir, vids=vids, preview=preview, layers=layers,
+                              blend=blend, workers=workers, overlap=overlap, todo=todo, batch=batch,
+                              compression=pngcompression, prefetch=prefetch)
+        reportThroughput(count, time.time() - now, workers, outputdir, dict(params, batch=batch, pipeline=pipeline))
+        if profile is 1:
+            profiler.save(os.path.join(outputdir, 'profile'), dict(params, workers=workers, batch=batch))
+        return
+
+    keypool = None
+    if keyframes is not None and benchmark is None:
+        # flow fields between neighbour frames are computed once on all cores, the motion detector,
+        # the keyframe chain and the interpolation read them from the cache. both pools are forked
+        # before this process loads the net, as a GPU context does not survive a fork
+        if flowcache is None:
+            flowcache = os.path.join(outputdir, 'flowcache')
+        now = time.time()
+        precomputeFlow(inputdir, flowcache, preview, 0, None)
+        if workers > 1:
+            keypool = multiprocessing.Pool(workers, initWorker if keyrefine else None,
+                                           (backend, modeldir, gpu, threads, guide, guidecache, layers, dreamparams)
+                                           if keyrefine else ())
+
+    if benchmark == 'core':
+        # no network involved
+        benchmarkCore(loadFrame(os.path.join(inputdir, listFrames(inputdir)[0]), preview), octaves, octave_scale,
+                      jitter, iterations)
+        return
+
+    net = loadNet(backend, modeldir, gpu, threads)
+    guide_features = None
+    if guide is not None:
+        guide_features = loadGuides(net, guide, layers, guidecache, [backend, modeldir])  # 'inception_3b/output'
+    getFrame = makeGetFrame(guide_features=guide_features, **dreamparams)
+
+    if benchmark is not None:
+        frame = loadFrame(os.path.join(inputdir, listFrames(inputdir)[0]), preview)
+        if benchmark == 'batch':
+            benchmarkBatch(net, frame, layers[0], octaves, octave_scale)
+        elif benchmark == 'guide':
+            if guide_features is None:
+                sys.exit('--benchmark guide needs --guide')
+            benchmarkGuide(net, frame, guide_features, octaves, octave_scale)
+        elif benchmark == 'tiles':
+            cases = [('-', makeGetFrame(guide_features=guide_features, **dict(dreamparams, tile=None)))]
+            for size in [tile] if tile else [512, 1024]:
+                cases.append((str(size), makeGetFrame(guide_features=guide_features, **dict(dreamparams, tile=size))))
+            benchmarkTiles(net, frame, layers[0], cases)
+        elif benchmark == 'draft':
+            # the first frames against a full render, every draft depth with and without a pass at full size
+            frames = [loadFrame(os.path.join(inputdir, name), preview) for name in listFrames(inputdir)[:3]]
+            full = dict(dreamparams, draft=None)
+            cases = [('full', makeGetFrame(guide_features=guide_features, **full))]
+            for depth in xrange(1, octaves):
+                for passes in sorted(set([0, draftiterations or 1])):
+                    cases.append(('draft %d +%d' % (depth, passes),
+                                  makeGetFrame(guide_features=guide_features,
+                                               **dict(full, draft=depth, draftiterations=passes))))
+            cases.append(('preview 1/2', previewGetFrame(cases[0][1], 2)))
+            benchmarkDraft(net, frames, layers[0], cases)
+        elif benchmark == 'memory':
+            frames = [loadFrame(os.path.join(inputdir, name), preview) for name in listFrames(inputdir)[:4]]
+            benchmarkMemory(net, frames, layers[0], lambda lean: makeGetFrame(guide_features=guide_features,
+                                                                              **dict(dreamparams, lean=lean)))
+        return
+
+    # load images & sort them
+    if binocular is 1:
+        vids = [listFrames(os.path.join(inputdir, 'Left')), listFrames(os.path.join(inputdir, 'Right'))]
+        assert len(vids[0]) == len(vids[1]), 'Left and right videos must have same number of frames'
+        now = time.time()
+        count = dreamBinocular(net, inputdir, outputdir, vids, getFrame, layers, flowcache, stereo, refine,
+                               pngcompression, prefetch)
+        reportThroughput(count, time.time() - now)
+        if profile is 1:
+            profiler.save(os.path.join(outputdir, 'profile'), dict(params, binocular=1, stereo=stereo, refine=refine))
+    elif pipe is 1:
+        # stream frames from the input video straight into the output video
+        width, height, sourcerate, numframe = probeVideo(inputdir)
+        if preview is not 0:
+            width, height = preview, int(height * preview / float(width))
+        width, height = width - width % 2, height - height % 2  # x264 needs even sizes
+        frames = readVideo(inputdir, width, height, buffersize)
+        writer = VideoWriter(outputdir, width, height, framerate or sourcerate, buffersize)
+        now = time.time()
+        if batch > 1:
+            count = dreamBatches(net, frames, writer, getFrame, numframe, layers, batch)
+        else:
+            schedulelog = os.path.splitext(outputdir)[0] + '.schedule.csv'
+            if adaptive is not None:
+                startSchedule(schedulelog)
+            count = dreamFrames(net, frames, writer, getFrame, numframe, layers, blend, flow, flowcache=flowcache,
+                                adaptive=adaptive, schedulelog=schedulelog, prefetch=prefetch, lean=lean is 1)
+        reportThroughput(count, time.time() - now)
+        if profile is 1:
+            profiler.save(os.path.splitext(outputdir)[0] + '.profile', dict(params, batch=batch))
+    elif keyframes is not None:
+        vids = listFrames(inputdir)
+        keys = chooseKeyframes(inputdir, vids, preview, keyframes, keymotion, flowcache)
+        print 'Dreaming %d keyframes of %d frames' % (len(keys), len(vids))
+        frames = ((index, os.path.join(inputdir, vids[index]), loadFrame(os.path.join(inputdir, vids[index]), preview))
+                  for index in keys)
+        count = dreamFrames(net, frames, PngWriter(outputdir, pngcompression), getFrame, len(vids), layers, blend, flow,
+                            flowcache=flowcache, prefetch=prefetch, lean=lean is 1)
+        worker.update(net=net, getFrame=getFrame)
+        try:
+            count += interpolateKeyframes(inputdir, outputdir, vids, preview, layers, keys, flowcache, keyrefine,
+                                          keypool, pngcompression)
+        finally:
+            if keypool is not None:
+                keypool.close()
+                keypool.join()
+        reportThroughput(count, time.time() - now)  # keyframe runs do not scale like frame by frame runs
+        if profile is 1:
+            profiler.save(os.path.join(outputdir, 'profile'), dict(params, keyframes=keys))
+    else:
+        vids = listFrames(inputdir)
+        manifest = startManifest(outputdir, params, vids, resume)
+        writer = PngWriter(outputdir, pngcompression)
+        last = manifest['last']
+        previous = None
+        if last >= 0:
+            # pick the flow or blend chain up from the last saved frame
+            print 'Resuming after frame ' + str(last)
+            previous = loadFrame(os.path.join(inputdir, vids[last]), preview), loadState(manifest, writer)
+            setRandomState(manifest['rng'])
+        frames = readDirectory(inputdir, vids, preview, last + 1)
+        if pipeline is 1:
+            writer = AsyncWriter(writer, buffersize)
+        now = time.time()
+        if batch > 1:
+            count = dreamBatches(net, frames, writer, getFrame, len(vids), layers, batch, manifest=manifest)
+        else:
+            schedulelog = os.path.join(outputdir, 'schedule.csv')
+            if adaptive is not None:
+                startSchedule(schedulelog, last)
+            count = dreamFrames(net, frames, writer, getFrame, len(vids), layers, blend, flow, previous=previous,
+                                manifest=manifest, flowcache=flowcache, adaptive=adaptive, schedulelog=schedulelog,
+                                prefetch=prefetch, lean=lean is 1)
+        # adaptive runs dream as many iterations as the footage needs, their speed is not comparable
+        reportThroughput(count, time.time() - now, 1, outputdir,
+                         dict(params, batch=batch, pipeline=pipeline) if adaptive is None else None)
+        if profile is 1:
+            profiler.save(os.path.join(outputdir, 'profile'), dict(params, batch=batch))
 
 
 def extractVideo(inputdir, outputdir):
@@ -437,12 +2553,76 @@ if __name__ == "__main__":
                         required=False)
     parser.add_argument('-e', '--extract', help='Extract Frames From Video.', type=int, required=False)
     parser.add_argument('-c', '--create', help='Create Video From Frames.', type=int, required=False)
-    parser.add_argument('-g', '--guide', help='Guided dream image input.', type=str, required=False)
+    parser.add_argument('-g', '--guide', help='Guided dream image input. One for all layers, or one per layer of --layers.',
+                        nargs='+', type=str, required=False)
+    parser.add_argument('-gc', '--guidecache', help='Directory to cache guide features in, shared between runs.',
+                        type=str, required=False)
+    parser.add_argument('-gch', '--guidechannels', help='Match guide features on this many principal components instead of all channels (faster, approximate).',
+                        type=int, required=False)
     parser.add_argument('-flow', '--flow', help='Optical Flow.', type=int, required=False)
     parser.add_argument('-gpu', '--gpu', help='Use GPU or CPU.', type=int, required=False)
     parser.add_argument('-f', '--framerate', help='Video creation Framerate.', type=int, required=False)
     parser.add_argument('-n','--binocular', help='Create 3D dream images from binocular input', type=int,
                         required=False)
+    parser.add_argument('-pipe', '--pipe', help='Stream frames from input video to output video through ffmpeg, without intermediate images.',
+                        type=int, required=False)
+    parser.add_argument('-buf', '--buffer', help='Frames kept in flight by the ffmpeg pipes. Default: 4', type=int,
+                        required=False)
+    parser.add_argument('-w', '--workers', help='Dream frames in this many processes. Default: 1', type=int,
+                        required=False)
+    parser.add_argument('-r', '--resume', help='Continue an interrupted run in the same output directory.', type=int,
+                        required=False)
+    parser.add_argument('-fc', '--flowcache', help='Directory to cache optical flow fields in, shared between runs.',
+                        type=str, required=False)
+    parser.add_argument('-pf', '--precomputeflow', help='Fill the flow cache given as output from the input frames.',
+                        type=int, required=False)
+    parser.add_argument('-be', '--backend', help='Network to dream with: caffe, torch (torchvision GoogLeNet) or synthetic (tiny random net, no download). Default: caffe',
+                        choices=sorted(BACKENDS), required=False)
+    parser.add_argument('-t', '--threads', help='CPU threads of the torch backend. Default: all cores', type=int,
+                        required=False)
+    parser.add_argument('-bs', '--batch', help='Dream this many frames at once, without flow and blend. Default: 1',
+                        type=int, required=False)
+    parser.add_argument('-bench', '--benchmark', help='Time parts of the dream on the first input frame: core, batch, tiles, guide, draft, memory.',
+                        choices=['core', 'batch', 'tiles', 'guide', 'draft', 'memory'], required=False)
+    parser.add_argument('-a', '--adaptive', help='With flow, give frames that barely change fewer iterations.', type=int,
+                        required=False)
+    parser.add_argument('-q', '--quality', help='Share of the iterations every frame gets with --adaptive. Default: 0.3',
+                        type=float, required=False)
+    parser.add_argument('-d', '--debug', help='Print every dream iteration.', type=int, required=False)
+    parser.add_argument('-tile', '--tile', help='Dream octaves larger than this many pixels a side in overlapping tiles, to bound memory.',
+                        type=int, required=False)
+    parser.add_argument('-prof', '--profile', help='Time every stage of every frame into profile.json and profile.csv.',
+                        type=int, required=False)
+    parser.add_argument('-pl', '--pipeline', help='Read frames and compute flow ahead, and save frames, on background threads while dreaming.',
+                        type=int, required=False)
+    parser.add_argument('-pc', '--pngcompression', help='PNG compression level of the saved frames, 0 (fastest) to 9. Default: 6',
+                        type=int, choices=range(10), required=False)
+    parser.add_argument('-st', '--stereo', help='How --binocular dreams the right eye: serial (after the left eye), batch (with the left eye) or reproject (the left dream, touched up). Default: serial',
+                        choices=STEREO_MODES, required=False)
+    parser.add_argument('-rf', '--refine', help='Iterations of the right eye with --stereo reproject, and of the first right frame with batch. Default: 2',
+                        type=int, required=False)
+    parser.add_argument('-sw', '--sweep', help='Dream the input with every config of this json file (grid or list of settings), writing a contact sheet and timings.',
+                        type=str, required=False)
+    parser.add_argument('-dr', '--draft', help='Dream only this many of the smallest octaves, and carry their details onto the full size frame. Fast drafts.',
+                        type=int, required=False)
+    parser.add_argument('-dri', '--draftiterations', help='Iterations at full size after the --draft octaves. Default: 0',
+                        type=int, required=False)
+    parser.add_argument('-k', '--keyframes', help='Dream every this many frames only, and carry the dream along the flow to the frames in between.',
+                        type=int, required=False)
+    parser.add_argument('-km', '--keymotion', help='With --keyframes, also start a keyframe once the frames since the last one moved this many pixels, and at cuts.',
+                        type=float, required=False)
+    parser.add_argument('-kr', '--keyrefine', help='Iterations on every frame between keyframes. Default: 0',
+                        type=int, required=False)
+    parser.add_argument('-qu', '--queue', help='Distributed rendering in the job directory given as output: submit the input frames, work on them (from any machine), status, retry failed segments. stitch takes the job directory as input.',
+                        choices=['submit', 'work', 'status', 'retry', 'stitch'], required=False)
+    parser.add_argument('-sg', '--segment', help='Frames per segment of a --queue job. Default: 50', type=int,
+                        required=False)
+    parser.add_argument('-ls', '--lease', help='Seconds a --queue work claim lasts without a heartbeat, before other workers take the segment over. Renewed every quarter of it while dreaming. Default: 600',
+                        type=int, required=False)
+    parser.add_argument('-le', '--lean', help='Keep frame state compact (int16 dream details, uint8 frames, fixed point flow) and free octave buffers early, to save memory.',
+                        type=int, required=False)
+    parser.add_argument('-ov', '--overlap', help='Warm-up frames dreamed before each chunk when using workers and blend. Default: 3',
+                        type=int, required=False)
 
     args = parser.parse_args()
 
@@ -452,6 +2632,42 @@ if __name__ == "__main__":
         framerate = 25
         if args.framerate is not None: framerate = args.framerate
         createVideo(args.input, args.output, framerate)
+    elif args.precomputeflow is 1:
+        precomputeFlow(args.input, args.output, args.preview, args.binocular, args.workers)
+    elif args.queue == 'stitch':
+        # input is the job directory, output the frames directory or a video file
+        stitchJob(args.input, args.output, args.framerate, args.buffer or 4)
     else:
+        if args.pipe is 1 and args.binocular is 1:
+            parser.error('--pipe does not support binocular input')
+        if args.sweep is not None and (args.binocular is 1 or args.pipe is 1 or args.resume is 1):
+            parser.error('--sweep does not support --binocular, --pipe or --resume')
+        if args.keyframes is not None and (args.keyframes < 2 or args.binocular is 1 or args.pipe is 1 or
+                                           args.resume is 1 or args.batch > 1 or args.sweep is not None):
+            parser.error('--keyframes must be at least 2, and does not support --binocular, --pipe, --resume, --batch or --sweep')
+        if args.queue is not None and (args.binocular is 1 or args.pipe is 1 or args.resume is 1 or args.batch > 1 or
+                                       args.sweep is not None or args.keyframes is not None):
+            parser.error('--queue does not support --binocular, --pipe, --resume, --batch, --sweep or --keyframes')
+        if args.workers > 1 and args.sweep is None and args.keyframes is None and args.queue is None and (args.flow is 1 or args.binocular is 1 or args.pipe is 1):
+            parser.error('--workers does not support --flow, --binocular or --pipe')
+        if args.batch > 1 and (args.flow is 1 or args.binocular is 1 or args.blend != 0):
+            parser.error('--batch needs --blend 0 and does not support --flow or --binocular')
+        if args.tile is not None and args.tile < 64:
+            parser.error('--tile must be at least 64')
+        if args.tile is not None and args.batch > 1:
+            parser.error('--tile does not support --batch')
+        if args.adaptive is 1 and args.flow is not 1:
+            parser.error('--adaptive needs --flow 1')
+        if args.resume is 1 and (args.binocular is 1 or args.pipe is 1):
+            parser.error('--resume does not support --binocular or --pipe')
+        if args.lean is 1 and args.binocular is 1:
+            parser.error('--lean does not support --binocular')
+        if args.stereo == 'batch' and args.tile is not None:
+            parser.error('--tile does not support --stereo batch')
         main(args.input, args.output, args.model, args.preview, args.octaves, args.octavescale, args.iterations, args.jitter,
-             args.zoom, args.stepsize, args.blend, args.layers, args.guide, args.gpu, args.flow, args.binocular)
+             args.zoom, args.stepsize, args.blend, args.layers, args.guide, args.gpu, args.flow, args.binocular,
+             args.pipe, args.framerate, args.buffer, args.workers, args.overlap, args.resume, args.flowcache,
+             args.batch, args.benchmark, args.backend, args.threads, args.tile, args.debug,
+             args.adaptive, args.quality, args.profile, args.pipeline, args.pngcompression, args.stereo,
+             args.refine, args.guidecache, args.guidechannels, args.sweep, args.draft, args.draftiterations,
+             args.keyframes, args.keymotion, args.keyrefine, args.queue, args.segment, args.lean, args.lease)